@@ -30,9 +30,65 @@
 
 from __future__ import print_function
 
+import gzip
 import os
+import shutil
+import subprocess
 import sys
 import tarfile
+import threading
+from io import BytesIO
+from multiprocessing import cpu_count
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# NOTE: scandir is built into os on python 3 but requires the stand-alone
+#       scandir module on python 2. Fall back to plain os.walk without it.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# NOTE: tarfile copies file data in small 16KB chunks by default, which means
+#       a lot of tiny read and write calls for a big source tree. We use a
+#       much bigger buffer and handle the gzip layer ourselves below.
+copy_bufsize = 2 * 1024 * 1024
+# Files up to this size are read ahead in the walker thread
+preload_max_size = 4 * copy_bufsize
+# Keep the read-ahead queue short to limit memory and concurrent disk reads
+preload_queue_size = 8
+
+
+def copy_buffered(src, dst, length=None, exception=IOError, bufsize=None):
+    """Drop-in replacement for the internal tarfile.copyfileobj helper using
+    a larger copy buffer. Accepts the extended signature of recent python
+    versions but falls back to the old one on python 2.
+    """
+    bufsize = bufsize or copy_bufsize
+    if length == 0:
+        return
+    if length is None:
+        shutil.copyfileobj(src, dst, bufsize)
+        return
+    blocks, remainder = divmod(length, bufsize)
+    for _ in range(blocks):
+        buf = src.read(bufsize)
+        if len(buf) < bufsize:
+            raise exception("unexpected end of data")
+        dst.write(buf)
+    if remainder != 0:
+        buf = src.read(remainder)
+        if len(buf) < remainder:
+            raise exception("unexpected end of data")
+        dst.write(buf)
+
+
+tarfile.copyfileobj = copy_buffered
 
 if len(sys.argv) < 2:
     print('Usage: %s VERSION TARGET' % sys.argv[0])
@@ -47,30 +103,179 @@ except:
     target = os.getcwd()
 
 exclude_dirs = ['.svn', 'user-projects']
+exclude_set = frozenset(exclude_dirs)
 archive_base = 'mig-%s' % version
 tar_path = '%s.tgz' % archive_base
 
+
+def find_binary(name):
+    """Lookup name in PATH and return full path or None if not found"""
+    for path_dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        bin_path = os.path.join(path_dir, name)
+        if os.path.isfile(bin_path) and os.access(bin_path, os.X_OK):
+            return bin_path
+    return None
+
+
+def system_tar_release(target, tar_path, archive_base, exclude_dirs):
+    """Create release tarball with the system tar piped through pigz or gzip.
+    The C implementations avoid the python per-entry overhead and pigz
+    compresses on all cores. Returns True on success and False if the
+    required binaries are unavailable or the pipeline failed.
+    """
+    tar_bin = find_binary('tar')
+    pigz_bin = find_binary('pigz')
+    if pigz_bin:
+        zip_cmd = [pigz_bin, '-p', '%d' % cpu_count()]
+    else:
+        zip_cmd = [find_binary('gzip')]
+    if not tar_bin or not zip_cmd[0]:
+        return False
+    tar_cmd = [tar_bin, '-cf', '-']
+    tar_cmd += ['--exclude=%s' % name for name in exclude_dirs]
+    tar_cmd.append('--exclude=%s*' % os.path.basename(tar_path))
+    # NOTE: rename leading dot to archive_base but leave symlink targets alone
+    tar_cmd.append('--transform=s,^\\.,%s,S' % archive_base)
+    tar_cmd.append('.')
+    print('Running %s | %s' % (' '.join(tar_cmd), ' '.join(zip_cmd)))
+    tar_file = open(tar_path, 'wb')
+    try:
+        tar_proc = subprocess.Popen(tar_cmd, cwd=target,
+                                    stdout=subprocess.PIPE)
+        zip_proc = subprocess.Popen(zip_cmd, stdin=tar_proc.stdout,
+                                    stdout=tar_file)
+        # Let tar receive SIGPIPE if the compressor exits early
+        tar_proc.stdout.close()
+        zip_status = zip_proc.wait()
+        tar_status = tar_proc.wait()
+    except OSError as err:
+        print('Failed to run system tar pipeline: %s' % err)
+        return False
+    finally:
+        tar_file.close()
+    if tar_status != 0 or zip_status != 0:
+        print('System tar pipeline failed: tar %d, zip %d' %
+              (tar_status, zip_status))
+        return False
+    return True
+
+
+def walk_scandir(top, exclude_set):
+    """Walk the tree at top similar to os.walk but skipping any exclude_set
+    names and yielding (root, dirs, entries) tuples, where entries are the
+    names to include in the tarball. That is, all files plus any symlinked
+    dirs, which are preserved as symlinks and not followed. The type checks
+    rely on the cached info in the scandir entries to avoid extra stat calls.
+    """
+    pending = [top]
+    while pending:
+        root = pending.pop()
+        dirs, entries = [], []
+        for entry in scandir(root):
+            if entry.name in exclude_set:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            else:
+                entries.append(entry.name)
+        yield (root, dirs, entries)
+        pending += [os.path.join(root, name) for name in reversed(dirs)]
+
+
+def walk_legacy(top, exclude_set):
+    """Fallback version of walk_scandir using os.walk and islink checks"""
+    for (root, dirs, files) in os.walk(top):
+        dirs[:] = [name for name in dirs if name not in exclude_set]
+        # Preserve e.g. 'shared' symlinks
+        entries = [name for name in files if name not in exclude_set]
+        entries += [name for name in dirs if
+                    os.path.islink(os.path.join(root, name))]
+        yield (root, dirs, entries)
+
+
+def preload_entries(target, tar_path, archive_base, exclude_set, tar_ball,
+                    entry_queue, errors):
+    """Walk target and queue (tar_info, data, rel_path) tuples for all entries
+    to include in the release. Contents of small regular files are read here
+    so that disk reads overlap with compression in the consumer thread. A
+    final None entry marks the end and any error is appended to errors.
+    """
+    if scandir is not None:
+        walker = walk_scandir
+    else:
+        walker = walk_legacy
+    # Hoist lookups out of the per-file loop
+    _join, _normpath = os.path.join, os.path.normpath
+    _gettarinfo, _put = tar_ball.gettarinfo, entry_queue.put
+    target_prefix = target + os.sep
+    try:
+        for (root, _, entries) in walker(target, exclude_set):
+            # NOTE: a single lstat through gettarinfo per entry gives us both
+            #       the header and the type.
+            for name in entries:
+                if name.startswith(tar_path):
+                    continue
+                path = _normpath(_join(root, name))
+                rel_path = path.replace(target_prefix, '')
+                archive_path = _join(archive_base, rel_path)
+                tar_info = _gettarinfo(rel_path, archive_path)
+                if tar_info is None:
+                    print('Skipping unsupported %s' % archive_path)
+                    continue
+                data = None
+                if tar_info.isreg() and tar_info.size <= preload_max_size:
+                    with open(rel_path, 'rb') as src:
+                        data = src.read()
+                _put((tar_info, data, rel_path))
+    except Exception as exc:
+        errors.append(exc)
+    finally:
+        _put(None)
+
+
+def python_tar_release(target, tar_path, archive_base, exclude_set):
+    """Create release tarball with the python tarfile and gzip modules. A
+    walker thread reads ahead while this thread compresses and writes.
+    """
+    # NOTE: open plain tar on top of our own gzip stream to avoid the small
+    #       internal buffering of the streaming 'w:gz' mode
+    gz_file = gzip.GzipFile(tar_path, mode='wb', compresslevel=6)
+    tar_ball = tarfile.open(fileobj=gz_file, mode='w')
+    entry_queue = queue.Queue(maxsize=preload_queue_size)
+    errors = []
+    walk_thread = threading.Thread(target=preload_entries,
+                                   args=(target, tar_path, archive_base,
+                                         exclude_set, tar_ball, entry_queue,
+                                         errors))
+    walk_thread.daemon = True
+    walk_thread.start()
+    _get, _addfile = entry_queue.get, tar_ball.addfile
+    while True:
+        entry = _get()
+        if entry is None:
+            break
+        (tar_info, data, rel_path) = entry
+        print('Adding %s' % tar_info.name)
+        if data is not None:
+            _addfile(tar_info, BytesIO(data))
+        elif tar_info.isreg():
+            with open(rel_path, 'rb', copy_bufsize) as src:
+                _addfile(tar_info, src)
+        else:
+            _addfile(tar_info)
+    walk_thread.join()
+    tar_ball.close()
+    gz_file.close()
+    if errors:
+        raise errors[0]
+
+
 if '__main__' == __name__:
     print('Creating release of %s in %s' % (target, tar_path))
     print('--- ignoring all %s dirs ---' % ', '.join(exclude_dirs))
-    tar_ball = tarfile.open(tar_path, 'w:gz')
-    for (root, dirs, files) in os.walk(target):
-        for exclude in exclude_dirs:
-            if exclude in dirs:
-                dirs.remove(exclude)
-        include_paths = files
-        # Preserve e.g. 'shared' symlinks
-        for name in dirs:
-            path = os.path.normpath(os.path.join(root, name))
-            if os.path.islink(path):
-                include_paths.append(name)
-        for name in include_paths:
-            if name.startswith(tar_path):
-                continue
-            path = os.path.normpath(os.path.join(root, name))
-            rel_path = path.replace(target + os.sep, '')
-            archive_path = os.path.join(archive_base, rel_path)
-            print('Adding %s' % archive_path)
-            tar_ball.add(rel_path, archive_path, recursive=False)
-    tar_ball.close()
+    if system_tar_release(target, tar_path, archive_base, exclude_dirs):
+        print('Wrote release of %s in %s' % (target, tar_path))
+        sys.exit(0)
+    print('Falling back to python tarfile packing')
+    python_tar_release(target, tar_path, archive_base, exclude_set)
     print('Wrote release of %s in %s' % (target, tar_path))
@@ -38,7 +38,7 @@ from copy import deepcopy
 from mig.server import genjobscriptpython
 from mig.server import genjobscriptsh
 from mig.server import genjobscriptjava
-from mig.shared.base import client_id_dir, hexlify
+from mig.shared.base import client_id_dir, force_native_str, hexlify
 from mig.shared.defaults import session_id_bytes, maxfill_fields, keyword_all
 from mig.shared.fileio import write_file, pickle, make_symlink
 from mig.shared.mrslparser import expand_variables
@@ -182,8 +182,8 @@ def create_job_script(
     # TODO: hexlify is an awfully space wasting URL-safe encoding.
     #       We should just use something like the proposed secure method from
     #       http://stackoverflow.com/a/23728630/2213647
-    sessionid = hexlify(open('/dev/urandom').read(session_id_bytes))
-    iosessionid = hexlify(open('/dev/urandom').read(session_id_bytes))
+    sessionid = force_native_str(hexlify(os.urandom(session_id_bytes)))
+    iosessionid = force_native_str(hexlify(os.urandom(session_id_bytes)))
     helper_dict_filename = os.path.join(configuration.resource_home,
                                         unique_resource_name,
                                         'empty_job_helper_dict.%s' % exe)
@@ -475,7 +475,7 @@ def create_arc_job(
         return (None, 'Error. empty job for ARC?')
 
     # generate random session ID:
-    sessionid = hexlify(open('/dev/urandom').read(session_id_bytes))
+    sessionid = force_native_str(hexlify(os.urandom(session_id_bytes)))
     logger.debug('session ID (for creating links): %s' % sessionid)
 
     client_dir = client_id_dir(client_id)
@@ -38,6 +38,7 @@ from __future__ import absolute_import
 
 import getopt
 import os
+import re
 import sys
 
 from mig.shared.accountreq import peers_permit_allowed, manage_pending_peers
@@ -49,6 +50,7 @@ from mig.shared.notification import notify_user
 from mig.shared.serial import load, dump
 from mig.shared.useradm import init_user_adm, search_users, default_search, \
     user_account_notify
+from mig.shared.userdb import default_db_path, load_user_db
 from mig.shared.validstring import valid_email_addresses
 
 
@@ -107,8 +109,7 @@ if '__main__' == __name__:
 
     for (opt, val) in opts:
         if opt == '-a':
-            raw_targets['email'] = raw_targets.get('email', [])
-            raw_targets['email'].append(keyword_auto)
+            raw_targets.setdefault('email', []).append(keyword_auto)
         elif opt == '-c':
             conf_path = val
         elif opt == '-C':
@@ -116,8 +117,7 @@ if '__main__' == __name__:
         elif opt == '-d':
             db_path = val
         elif opt == '-e':
-            raw_targets['email'] = raw_targets.get('email', [])
-            raw_targets['email'].append(val)
+            raw_targets.setdefault('email', []).append(val)
         elif opt == '-E':
             if val != keyword_auto:
                 search_filter['email'] = val.lower()
@@ -129,9 +129,7 @@ if '__main__' == __name__:
         elif opt == '-I':
             search_filter['distinguished_name'] = val
         elif opt == '-s':
-            val = val.lower()
-            raw_targets[val] = raw_targets.get(val, [])
-            raw_targets[val].append('SETTINGS')
+            raw_targets.setdefault(val.lower(), []).append('SETTINGS')
         elif opt == '-u':
             user_file = val
         elif opt == '-v':
@@ -147,11 +145,9 @@ if '__main__' == __name__:
 
     if verbose:
         if conf_path:
-            if verbose:
-                print('using configuration in %s' % conf_path)
+            print('using configuration in %s' % conf_path)
         else:
-            if verbose:
-                print('using configuration from MIG_CONF (or default)')
+            print('using configuration from MIG_CONF (or default)')
 
     configuration = get_configuration_object(config_file=conf_path)
     logger = configuration.logger
@@ -198,7 +194,10 @@ if '__main__' == __name__:
         peer_emails = valid_email_addresses(configuration, peers_source)
         if peer_emails[1:]:
             regex_keys.append('email')
-            search_filter['email'] = '(' + '|'.join(peer_emails) + ')'
+            # NOTE: escape addresses and compile once for the user DB scan
+            search_filter['email'] = re.compile(
+                '^(' + '|'.join([re.escape(i) for i in peer_emails]) + ')$',
+                re.IGNORECASE)
         elif peer_emails:
             search_filter['email'] = peer_emails[0]
         elif search_filter['distinguished_name']:
@@ -214,10 +213,20 @@ if '__main__' == __name__:
         print('Handling peer %s request to users matching %s' %
               (peer_id, search_filter))
 
+    # NOTE: load configuration and user DB just once here and reuse them for
+    #       the search and all the notify address lookups below
+    if db_path == keyword_auto:
+        db_path = default_db_path(configuration)
+    try:
+        user_db = load_user_db(db_path)
+    except Exception as err:
+        print('Failed to load user DB from %s: %s' % (db_path, err))
+        sys.exit(1)
+
     # Lookup users to request formal acceptance from
-    (_, hits) = search_users(search_filter, conf_path,
-                             db_path, verbose, regex_match=regex_keys)
-    logger = configuration.logger
+    (_, hits) = search_users(search_filter, configuration,
+                             user_db, verbose, regex_match=regex_keys)
+    check_gdp = configuration.site_enable_gdp
     gdp_prefix = "%s=" % gdp_distinguished_field
 
     if len(hits) < 1:
@@ -239,8 +248,9 @@ if '__main__' == __name__:
         if verbose:
             print('Check for %s' % user_id)
 
-        if configuration.site_enable_gdp and \
-                user_id.split('/')[-1].startswith(gdp_prefix):
+        # NOTE: check last DN field without splitting into a throw-away list
+        if check_gdp and \
+                user_id.startswith(gdp_prefix, user_id.rfind('/') + 1):
             if verbose:
                 print("Skip GDP project account: %s" % user_id)
             continue
@@ -262,7 +272,7 @@ if '__main__' == __name__:
         print("Added peer request from %s to %s" % (peer_id, user_id))
 
         (_, _, full_name, addresses, errors) = user_account_notify(
-            user_id, raw_targets, conf_path, db_path, verbose, admin_copy)
+            user_id, raw_targets, configuration, user_db, verbose, admin_copy)
         if errors:
             print("Address lookup errors for %s :" % user_id)
             print('\n'.join(errors))
@@ -59,28 +59,19 @@ from mig.shared.useradm import user_request_reject, user_account_notify, \
 from mig.shared.userdb import default_db_path
 from mig.shared.validstring import valid_email_addresses
 
-
-def account_css_helpers(configuration):
-    """CSS to include in the cert/oid account req page header"""
-    css = '''
-<link rel="stylesheet" type="text/css" href="/images/css/jquery.accountform.css" media="screen"/>
-    '''
-    return css
-
-
-def account_js_helpers(configuration, fields):
-    """Javascript to include in the cert/oid account req page header"""
-    # TODO: change remaining names and messages to fit generic auth account?
-    add_import = '''
+# NOTE: most of the account request javascript is static so we prepare it
+#       once at import and only fill in the few dynamic parts on use.
+_account_js_import = '''
 <script type="text/javascript" src="/images/js/jquery.form.js"></script>
 <script type="text/javascript" src="/images/js/jquery.accountform.js"></script>
     '''
-    add_init = """
+_account_js_vars_template = """
   /* Helper to define countries for which State field makes sense */
   var enable_state = ['US', 'CA', 'AU'];
   var peers_mandatory = %(peers_mandatory)s;
   var peers_explicit_fields = %(peers_explicit_fields)s;
-
+"""
+_account_js_functions = """
   function rtfm_warn(message) {
       return confirm(message + ': Proceed anyway? (If you read and followed the instructions!)');
   }
@@ -117,11 +108,7 @@ def account_js_helpers(configuration, fields):
       }
   }
   function deprecated_email(value) {
-      if (value.search('@gmail.com') != -1 || value.search('@yahoo.com') != -1 || value.search('@hotmail.com') != -1) {
-          return true;
-      } else {
-          return false;
-      }
+      return /@(gmail|yahoo|hotmail)\\.com/i.test(value);
   }
 
   function check_account_id() {
@@ -154,17 +141,18 @@ def account_js_helpers(configuration, fields):
   }
   function check_email() {
       //alert('#email_help');
-      if (!valid_email($('#email_field').val())) {
+      var email = $('#email_field').val();
+      if (!valid_email(email)) {
           return rtfm_warn('Email is invalid');
       }
-      if (deprecated_email($('#email_field').val())) {
+      if (deprecated_email(email)) {
           return rtfm_warn('Email does not look like an organization address');
       }
       return true;
   }
   function check_organization() {
       //alert('#organization_help');
-      if ($('#email_field').val().search('.ku.dk') != -1 || $('#email_field').val().search('diku.dk') != -1 || $('#email_field').val().search('nbi.dk') != -1) {
+      if (/[@.](ku|diku|nbi)\\.dk$/i.test($('#email_field').val().trim())) {
           if ($('#organization_field').val().indexOf(' ') != -1) {
               return rtfm_warn('Organization does not look like an acronym');
           }
@@ -181,7 +169,8 @@ def account_js_helpers(configuration, fields):
   function check_state() {
       //alert('#state_help');
       if (enable_state.indexOf($('#country_field').val()) == -1) {
-          if ($('#state_field').val() && $('#state_field').val() != 'NA') {
+          var state = $('#state_field').val();
+          if (state && state != 'NA') {
               return rtfm_warn('State only makes sense for '+enable_state.join(', ')+' users');
           }
       }
@@ -189,20 +178,22 @@ def account_js_helpers(configuration, fields):
   }
   function check_password() {
       //alert('#password_help');
-      if ($('#password_field').val().length < %(password_min_len)d) {
+      var password_len = $('#password_field').val().length;
+      if (password_len < %(password_min_len)d) {
          return rtfm_warn('Password too short');
-      } else if ($('#password_field').val().length > %(password_max_len)d) {
+      } else if (password_len > %(password_max_len)d) {
          return rtfm_warn('Password too long');
       }
       return true;
   }
   function check_verifypassword() {
       //alert('#verifypassword_help');
-      if ($('#verifypassword_field').val().length < %(password_min_len)d) {
+      var verifypassword = $('#verifypassword_field').val();
+      if (verifypassword.length < %(password_min_len)d) {
          return rtfm_warn('Verify password too short');
-      } else if ($('#verifypassword_field').val().length > %(password_max_len)d) {
+      } else if (verifypassword.length > %(password_max_len)d) {
          return rtfm_warn('Verify password too long');
-      } else if ($('#password_field').val() != $('#verifypassword_field').val()) {
+      } else if ($('#password_field').val() != verifypassword) {
          return rtfm_warn('Mismatch between password and verify password');
       }
       return true;
@@ -237,6 +228,7 @@ def account_js_helpers(configuration, fields):
       var base_err = 'One or more peers contact emails must be provided';
       /* NOTE: split on comma and verbatim 'and' with space removal */
       var all_parts = $('#peers_email_field').val().trim().split(/\s*,\s*|\s+and\s+/);
+      var own_email = $('#email_field').val().trim().toLowerCase();
       if (all_parts.length < 1) {
           rtfm_error(base_err);
           return false;
@@ -247,7 +239,7 @@ def account_js_helpers(configuration, fields):
               rtfm_error('Peer contact email is invalid: '+ \
                          all_parts[i] + '\\n' + base_err);
               return false;
-          } else if (all_parts[i].trim().toLowerCase() === $('#email_field').val().trim().toLowerCase()) {
+          } else if (all_parts[i].trim().toLowerCase() === own_email) {
               rtfm_error(
                   'Peer contact email cannot be your own, '+all_parts[i]);
               $('#peers_email_field')[0].setCustomValidity(base_err);
@@ -306,25 +298,28 @@ def account_js_helpers(configuration, fields):
       }
   }
 
+  /* Cached help and window lookups shared by all focus handlers */
+  var contextualHelp, contextualHelpMessage, contextualWindow;
+
   function init_context_help() {
+      contextualHelp = $('#contextual_help');
+      contextualHelpMessage = contextualHelp.find('.help_message');
+      contextualWindow = $(window);
       /* move help text just right of connecting gfx bubble */
-      var contextualHelpMessage = $('#contextual_help').find('.help_message');
       contextualHelpMessage.offset({top: -30})
       contextualHelpMessage.offset({left: 40})
   }
   function close_context_help() {
       //alert('close called');
-      $('#contextual_help').hide();
-      $('#contextual_help').css({top: '', left: ''}); // fix for 'drifting' on IE/Chrome
+      contextualHelp.hide();
+      contextualHelp.css({top: '', left: ''}); // fix for 'drifting' on IE/Chrome
   }
   function bind_help(input_element, message) {
       input_element.focus(function () {
           close_context_help();
-          var contextualHelp = $('#contextual_help');
-          var contextualHelpMessage = $('#contextual_help').find('.help_message');
           contextualHelpMessage.html(message);
           var inputOffset = $(this).offset(); // top, left
-          var scrollTop = $(window).scrollTop(); // how much should we offset if the user has scrolled down the page?
+          var scrollTop = contextualWindow.scrollTop(); // how much should we offset if the user has scrolled down the page?
           contextualHelp.offset({
               //top: (inputOffset.top + scrollTop + .5 * $(this).height()) - .5 * contextualHelp.height(),
               top: inputOffset.top + scrollTop,
@@ -336,36 +331,65 @@ def account_js_helpers(configuration, fields):
       });
   }
 """ % {'password_min_len': password_min_len,
-       'password_max_len': password_max_len,
-       'peers_mandatory': ("%s" % configuration.site_peers_mandatory).lower(),
-       'peers_explicit_fields': "%s" % configuration.site_peers_explicit_fields,
-       }
-    add_init += """
+       'password_max_len': password_max_len}
+_account_js_validate_head = """
   function validate_form() {
       //alert('validate form');
-"""
-    # NOTE: dynamically add checks for all explicit peers fields configured
-    checks = [] + fields
-    for field_name in configuration.site_peers_explicit_fields:
-        checks.append("peers_%s" % field_name)
-    add_init += """
-      var status = %s""" % ' && '.join(['check_%s()' % name for name in checks])
-    add_init += """
+
+      var status = """
+_account_js_validate_tail = """
       //alert('old validate form: ' +status);
       return status;
   }
 
 """
-    add_ready = """
+_account_js_ready_head = """
       init_context_help();
 
 """
+_account_js_bind_template = """
+      bind_help($('#%(name)s_field'), $('#%(name)s_help').html());
+"""
+# Cache of generated account request javascript helpers
+_account_js_cache = {}
+
+
+def account_css_helpers(configuration):
+    """CSS to include in the cert/oid account req page header"""
+    css = '''
+<link rel="stylesheet" type="text/css" href="/images/css/jquery.accountform.css" media="screen"/>
+    '''
+    return css
+
+
+def account_js_helpers(configuration, fields):
+    """Javascript to include in the cert/oid account req page header"""
+    # NOTE: the result only depends on fields and a few static conf values so
+    #       we reuse it on repeated calls e.g. in wsgi mode
+    cache_key = (tuple(fields), configuration.site_peers_mandatory,
+                 tuple(configuration.site_peers_explicit_fields))
+    cached = _account_js_cache.get(cache_key, None)
+    if cached is not None:
+        return cached
+    # TODO: change remaining names and messages to fit generic auth account?
+    add_vars = _account_js_vars_template % {
+        'peers_mandatory': ("%s" % configuration.site_peers_mandatory).lower(),
+        'peers_explicit_fields': "%s" % configuration.site_peers_explicit_fields,
+    }
+    # NOTE: dynamically add checks for all explicit peers fields configured
+    checks = [] + fields
+    for field_name in configuration.site_peers_explicit_fields:
+        checks.append("peers_%s" % field_name)
+    add_init = ''.join([add_vars, _account_js_functions,
+                        _account_js_validate_head,
+                        ' && '.join(['check_%s()' % name for name in checks]),
+                        _account_js_validate_tail])
     # TODO: add help for peers fields here?
-    for name in fields:
-        add_ready += """
-      bind_help($('#%s_field'), $('#%s_help').html());
-""" % (name, name)
-    return (add_import, add_init, add_ready)
+    add_ready = _account_js_ready_head + ''.join(
+        [_account_js_bind_template % {'name': name} for name in fields])
+    helpers = (_account_js_import, add_init, add_ready)
+    _account_js_cache[cache_key] = helpers
+    return helpers
 
 
 def account_request_template(configuration, password=True, default_values={}):
@@ -1129,21 +1153,28 @@ def list_country_codes(configuration):
     return country_list
 
 
+# Policy regexps: prioritized order with most general last
+_force_org_email = [('DIKU', ['^[a-zA-Z0-9_.+-]+@diku.dk$',
+                              '^[a-zA-Z0-9_.+-]+@di.ku.dk$']),
+                    ('NBI', ['^[a-zA-Z0-9_.+-]+@nbi.ku.dk$',
+                             '^[a-zA-Z0-9_.+-]+@nbi.dk$',
+                             '^[a-zA-Z0-9_.+-]+@fys.ku.dk$']),
+                    ('IMF', ['^[a-zA-Z0-9_.+-]+@math.ku.dk$']),
+                    # Keep this KU catch-all last and do not generalize it!
+                    ('KU', ['^[a-zA-Z0-9_.+-]+@(alumni.|)ku.dk$']),
+                    ]
+_force_org_email_dict = dict(_force_org_email)
+# Compile policy regexps once and for all
+_force_org_email_exprs = [(org, [(pattern, re.compile(pattern)) for pattern in
+                                 patterns]) for (org, patterns) in
+                          _force_org_email]
+
+
 def forced_org_email_match(org, email, configuration):
     """Check that email and organization follow the required policy"""
 
     logger = configuration.logger
-    # Policy regexps: prioritized order with most general last
-    force_org_email = [('DIKU', ['^[a-zA-Z0-9_.+-]+@diku.dk$',
-                                 '^[a-zA-Z0-9_.+-]+@di.ku.dk$']),
-                       ('NBI', ['^[a-zA-Z0-9_.+-]+@nbi.ku.dk$',
-                                '^[a-zA-Z0-9_.+-]+@nbi.dk$',
-                                '^[a-zA-Z0-9_.+-]+@fys.ku.dk$']),
-                       ('IMF', ['^[a-zA-Z0-9_.+-]+@math.ku.dk$']),
-                       # Keep this KU catch-all last and do not generalize it!
-                       ('KU', ['^[a-zA-Z0-9_.+-]+@(alumni.|)ku.dk$']),
-                       ]
-    force_org_email_dict = dict(force_org_email)
+    force_org_email_dict = _force_org_email_dict
     is_forced_email = False
     is_forced_org = False
     if org.upper() in force_org_email_dict:
@@ -1151,10 +1182,11 @@ def forced_org_email_match(org, email, configuration):
         # Consistent casing
         org = org.upper()
     email_hit = '__BOGUS__'
-    for (forced_org, forced_email_list) in force_org_email:
-        for forced_email in forced_email_list:
-            # Consistent casing
-            if re.match(forced_email, email.lower()):
+    # Consistent casing
+    email = email.lower()
+    for (forced_org, forced_email_list) in _force_org_email_exprs:
+        for (forced_email, forced_expr) in forced_email_list:
+            if forced_expr.match(email):
                 is_forced_email = True
                 email_hit = forced_email
                 logger.debug('email match on %s vs %s' % (email, forced_email))
@@ -33,7 +33,6 @@ import Cookie
 import base64
 import glob
 import os
-import re
 import time
 
 # Only needed for 2FA so ignore import error and only fail on use
@@ -42,7 +41,8 @@ try:
 except ImportError:
     pyotp = None
 
-from mig.shared.base import client_id_dir, extract_field, force_utf8
+from mig.shared.base import client_id_dir, extract_field, force_utf8, \
+    force_native_str
 from mig.shared.defaults import twofactor_key_name, twofactor_interval_name, \
     twofactor_key_bytes, twofactor_cookie_bytes, twofactor_cookie_ttl
 from mig.shared.fileio import read_file, delete_file, delete_symlink, \
@@ -241,7 +241,11 @@ def generate_session_key(configuration, client_id):
             configuration, client_id, expand_oid_alias=False)
     session_key = generate_session_prefix(configuration, client_id)
     random_key = os.urandom(twofactor_cookie_bytes)
-    session_key += re.sub(r'[=+/]+', '', base64.b64encode(random_key))
+    # NOTE: session keys must stay strictly alphanumeric for the apache 2FA
+    #       cookie rewrite rules so we drop the non-alnum b64 chars with a
+    #       plain translate rather than a regex or the urlsafe alphabet.
+    session_key += force_native_str(base64.b64encode(random_key).translate(
+        None, b'=+/'))
     return session_key
 
 
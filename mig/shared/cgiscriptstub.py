@@ -120,18 +120,25 @@ def finish_cgi_script(configuration, backend, output_format, ret_code, ret_msg,
     # NOTE: we need to carefully handle byte output here as well
     # https://stackoverflow.com/questions/40450791/python-cgi-print-image-to-html
 
+    # NOTE: we write headers and content to the same buffered stream and only
+    #       flush at the end to let small responses go out in a single write
+
     try:
         #logger.debug("write headers: %s" % header_out)
-        sys.stdout.write(header_out)
-        sys.stdout.write("\n\n")
-        #logger.debug("flush stdout")
-        sys.stdout.flush()
         #logger.debug("write content: %s" % [output[:64], '..', output[-64:]])
         # NOTE: py2 does not have buffer but py3 needs binary output there
         if sys.version_info[0] < 3:
+            sys.stdout.write(header_out)
+            sys.stdout.write("\n\n")
             sys.stdout.write(output)
         else:
+            # Push out any pending text output before using binary buffer
+            sys.stdout.flush()
+            sys.stdout.buffer.write(header_out.encode('utf8'))
+            sys.stdout.buffer.write(b"\n\n")
             sys.stdout.buffer.write(output)
+        #logger.debug("flush stdout")
+        sys.stdout.flush()
         # logger.debug("complete")
     except Exception as exc:
         logger.error("CGI output delivery crashed: %s" % exc)
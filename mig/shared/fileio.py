@@ -42,22 +42,24 @@ import zipfile
 # NOTE: We expose optimized walk function directly for ease and efficiency.
 #       Requires stand-alone scandir module on python 2 whereas the native os
 #       functions are built-in and optimized similarly on python 3+
-slow_walk, slow_listdir = False, False
+slow_walk, slow_listdir, slow_scandir = False, False, False
 if sys.version_info[0] > 2:
-    from os import walk, listdir
+    from os import walk, listdir, scandir
 else:
     try:
         from distutils.version import StrictVersion
-        from scandir import walk, listdir, __version__ as scandir_version
+        from scandir import walk, listdir, scandir, \
+            __version__ as scandir_version
         if StrictVersion(scandir_version) < StrictVersion("1.3"):
             # Important os.walk compatibility utf8 fixes were not added until 1.3
             raise ImportError(
                 "scandir version is too old: fall back to os.walk")
     except ImportError as err:
         # print("DEBUG: not using scandir: %s" % err)
-        slow_walk = slow_listdir = True
+        slow_walk = slow_listdir = slow_scandir = True
         walk = os.walk
         listdir = os.listdir
+        scandir = None
 
 try:
     from mig.shared.base import force_utf8_rec
@@ -362,12 +364,14 @@ def unpickle(path, logger, allow_missing=False):
         return False
 
 
-def pickle(data_object, path, logger):
-    """Pack data_object as pickled object in path"""
+def pickle(data_object, path, logger, protocol=0):
+    """Pack data_object as pickled object in path. The optional protocol
+    argument can be used to select a more compact binary pickle protocol.
+    """
     if not logger:
         logger = null_logger("dummy")
     try:
-        dump(data_object, path)
+        dump(data_object, path, protocol)
         # logger.debug("pickled %r successfully" % path)
         return True
     except Exception as err:
@@ -521,12 +525,14 @@ def makedirs_rec(dir_path, configuration, accept_existing=True):
     ignoring if dir_path already exists.
     """
     _logger = configuration.logger
+    # NOTE: just try and only stat on failure to save a syscall in the common
+    #       case and avoid racing other processes creating dir_path
     try:
-        if os.path.exists(dir_path) and not os.path.isdir(dir_path):
-            _logger.error("Non-directory %r in the way" % dir_path)
-            return False
         os.makedirs(dir_path)
     except OSError as err:
+        if err.errno == errno.EEXIST and not os.path.isdir(dir_path):
+            _logger.error("Non-directory %r in the way" % dir_path)
+            return False
         if not accept_existing or err.errno != errno.EEXIST:
             _logger.error("Could not make dir(s) %r: %s" % (dir_path, err))
             return False
@@ -30,8 +30,10 @@
 from __future__ import absolute_import
 
 import base64
+import os
 
 from mig.shared import returnvalues
+from mig.shared.base import force_native_str
 from mig.shared.defaults import max_software_entries, max_environment_entries, \
     csrf_field
 from mig.shared.functional import validate_input_and_cert
@@ -41,6 +43,128 @@ from mig.shared.refunctions import is_runtime_environment, \
     list_runtime_environments, get_re_dict
 from mig.shared.rekeywords import get_keywords_dict
 
+# NOTE: the keywords are static and the list of runtime envs only changes when
+#       an entry is added or removed in re_home, so we cache both between
+#       requests e.g. in wsgi mode and only refresh the list on dir changes.
+_rekeywords_dict = None
+_re_list_cache = {'re_home': None, 'mtime': None, 'value': None}
+
+# NOTE: the static html snippets and fill templates only need to be set up
+#       once rather than on every request.
+_template_select_head = """<form method='get' action='adminre.py'>
+    <select name='re_template'>
+    <option value=''>None</option>
+"""
+_template_select_option = "    <option value='%(re_name)s'>%(re_name)s</option>\n"
+_template_select_tail = """
+    </select>
+    <input type='submit' value='Get' />
+</form>"""
+_entries_form = """<form method='get' action='adminre.py'>
+    <table>
+
+<tr>
+    <td>Number of needed software entries</td>
+    <td><input type='number' name='software_entries' min=0 max=99
+    minlength=1 maxlength=2 value='%(software_entries)s' required pattern='[0-9]{1,2}'
+    title='number of software entries needed in runtime environment' /></td>
+</tr>
+<tr>
+    <td>Number of environment entries</td>
+    <td>
+    <input type='number' name='environment_entries' min=0 max=99
+    minlength=1 maxlength=2 value='%(environment_entries)s' required pattern='[0-9]{1,2}'
+    title='number of environment variables provided by runtime environment' />
+    </td>
+</tr>"""
+_testprocedure_select = {
+    0: """<option value='0' selected>No</option>
+<option value=1>Yes</option>""",
+    1: """<option value='0'>No</option>
+<option value='1' selected>Yes</option>"""}
+_update_fields_form = """
+<tr>
+    <td>Runtime environment has a testprocedure</td>
+    <td><select name='testprocedure_entry'>%(select_string)s</select></td>
+</tr>
+<tr>
+    <td colspan=2>
+    <input type='hidden' name='re_template' value='%(re_template)s' />
+    <input type='submit' value='Update fields' />
+    </td>
+</tr>
+</table>
+</form><br />
+"""
+_create_form_head = """
+<form method='%(form_method)s' action='%(target_op)s.py'>
+<input type='hidden' name='%(csrf_field)s' value='%(csrf_token)s' />
+<b>Runtime Environment Name</b><br />
+<small>(eg. BASH-2.X-1, must be unique):</small><br />
+<input class='p80width' type='text' name='re_name' required 
+    pattern='[a-zA-Z0-9_.-]+'
+    title='unique name of ASCII letters and digits separated only by underscores, periods and hyphens' />
+<br />
+<br /><b>Description:</b><br />
+<textarea class='p80width' rows='4' name='redescription'>
+"""
+_software_area = """
+<textarea class='p80width' rows='6' name='software'>"""
+_environment_area = """
+<textarea class='p80width' rows='4' name='environment'>"""
+_testprocedure_area = """
+<br /><b>Testprocedure</b> (in mRSL format):<br />
+<textarea class='p80width' rows='15' name='testprocedure'>"""
+_verifystdout_area = """
+<br /><b>Expected .stdout file if testprocedure is executed</b><br />
+<textarea class='p80width' rows='10' name='verifystdout'>"""
+_verifystderr_area = """
+<br /><b>Expected .stderr file if testprocedure is executed</b><br />
+<textarea cols='50' rows='10' name='verifystderr'>"""
+_verifystatus_area = """
+<br /><b>Expected .status file if testprocedure is executed</b><br />
+<textarea cols='50' rows='10' name='verifystatus'>"""
+_default_testprocedure = """::EXECUTE::
+ls    
+</textarea>
+<br /><b>Expected .stdout file if testprocedure is executed</b><br />
+<textarea class='p80width' rows='10' name='verifystdout'></textarea>
+<br /><b>Expected .stderr file if testprocedure is executed</b><br />
+<textarea class='p80width' rows='10' name='verifystderr'></textarea>
+<br /><b>Expected .status file if testprocedure is executed</b><br />
+<textarea class='p80width' rows='10' name='verifystatus'></textarea>
+"""
+_create_form_tail = """<br /><br /><input type='submit' value='Create' />
+    </form>
+"""
+
+
+def _get_keywords_dict():
+    """Lazy load and cache the static runtime env keywords dictionary"""
+    global _rekeywords_dict
+    if _rekeywords_dict is None:
+        _rekeywords_dict = get_keywords_dict()
+    return _rekeywords_dict
+
+
+def _list_runtime_environments(configuration):
+    """Cached version of list_runtime_environments refreshed only if the
+    runtime env dir changed since last call.
+    """
+    try:
+        re_mtime = os.stat(configuration.re_home).st_mtime
+    except OSError:
+        re_mtime = None
+    if re_mtime is not None and \
+            _re_list_cache['re_home'] == configuration.re_home and \
+            _re_list_cache['mtime'] == re_mtime:
+        return (True, _re_list_cache['value'])
+    (list_status, ret) = list_runtime_environments(configuration)
+    if list_status and re_mtime is not None:
+        _re_list_cache.update({'re_home': configuration.re_home,
+                               'mtime': re_mtime, 'value': ret})
+    return (list_status, ret)
+
 
 def signature():
     """Signature of the main function"""
@@ -130,8 +254,8 @@ def main(client_id, user_arguments_dict):
              (max_environment_entries, environment_entries)})
         return (output_objects, returnvalues.CLIENT_ERROR)
 
-    rekeywords_dict = get_keywords_dict()
-    (list_status, ret) = list_runtime_environments(configuration)
+    rekeywords_dict = _get_keywords_dict()
+    (list_status, ret) = _list_runtime_environments(configuration)
     if not list_status:
         output_objects.append({'object_type': 'error_text', 'text': ret})
         return (output_objects, returnvalues.SYSTEM_ERROR)
@@ -140,19 +264,12 @@ def main(client_id, user_arguments_dict):
         {'object_type': 'text', 'text':
          'Use existing Runtime Environment as template'})
 
-    html_form = \
-        """<form method='get' action='adminre.py'>
-    <select name='re_template'>
-    <option value=''>None</option>
-"""
-    for existing_re in ret:
-        html_form += "    <option value='%s'>%s</option>\n" % \
-                     (existing_re, existing_re)
-    html_form += """
-    </select>
-    <input type='submit' value='Get' />
-</form>"""
-    output_objects.append({'object_type': 'html_form', 'text': html_form})
+    html_parts = [_template_select_head]
+    html_parts += [_template_select_option % {'re_name': existing_re}
+                   for existing_re in ret]
+    html_parts.append(_template_select_tail)
+    output_objects.append({'object_type': 'html_form', 'text':
+                           ''.join(html_parts)})
 
     output_objects.append(
         {'object_type': 'text', 'text':
@@ -167,33 +284,12 @@ all data in the form, so please enter the correct values before entering any
 information.'''
          })
 
-    html_form = \
-        """<form method='get' action='adminre.py'>
-    <table>
-"""
-    html_form += """
-<tr>
-    <td>Number of needed software entries</td>
-    <td><input type='number' name='software_entries' min=0 max=99
-    minlength=1 maxlength=2 value='%s' required pattern='[0-9]{1,2}'
-    title='number of software entries needed in runtime environment' /></td>
-</tr>""" % software_entries
-    html_form += """
-<tr>
-    <td>Number of environment entries</td>
-    <td>
-    <input type='number' name='environment_entries' min=0 max=99
-    minlength=1 maxlength=2 value='%s' required pattern='[0-9]{1,2}'
-    title='number of environment variables provided by runtime environment' />
-    </td>
-</tr>""" % environment_entries
-    output_objects.append({'object_type': 'html_form', 'text': html_form})
-    if testprocedure_entry == 0:
-        select_string = """<option value='0' selected>No</option>
-<option value=1>Yes</option>"""
-    elif testprocedure_entry == 1:
-        select_string = """<option value='0'>No</option>
-<option value='1' selected>Yes</option>"""
+    entries_helpers = {'software_entries': software_entries,
+                       'environment_entries': environment_entries}
+    output_objects.append({'object_type': 'html_form', 'text':
+                           _entries_form % entries_helpers})
+    if testprocedure_entry in _testprocedure_select:
+        select_string = _testprocedure_select[testprocedure_entry]
     else:
         output_objects.append(
             {'object_type': 'error_text', 'text':
@@ -201,20 +297,8 @@ information.'''
              testprocedure_entry})
         return (output_objects, returnvalues.CLIENT_ERROR)
 
-    html_form = """
-<tr>
-    <td>Runtime environment has a testprocedure</td>
-    <td><select name='testprocedure_entry'>%s</select></td>
-</tr>
-<tr>
-    <td colspan=2>
-    <input type='hidden' name='re_template' value='%s' />
-    <input type='submit' value='Update fields' />
-    </td>
-</tr>
-</table>
-</form><br />
-""" % (select_string, re_template)
+    html_parts = [_update_fields_form % {'select_string': select_string,
+                                         're_template': re_template}]
 
     form_method = 'post'
     csrf_limit = get_csrf_limit(configuration)
@@ -226,35 +310,23 @@ information.'''
     csrf_token = make_csrf_token(configuration, form_method, target_op,
                                  client_id, csrf_limit)
     fill_helpers.update({'target_op': target_op, 'csrf_token': csrf_token})
-    html_form += """
-<form method='%(form_method)s' action='%(target_op)s.py'>
-<input type='hidden' name='%(csrf_field)s' value='%(csrf_token)s' />
-<b>Runtime Environment Name</b><br />
-<small>(eg. BASH-2.X-1, must be unique):</small><br />
-<input class='p80width' type='text' name='re_name' required 
-    pattern='[a-zA-Z0-9_.-]+'
-    title='unique name of ASCII letters and digits separated only by underscores, periods and hyphens' />
-<br />
-<br /><b>Description:</b><br />
-<textarea class='p80width' rows='4' name='redescription'>
-"""
+    html_parts.append(_create_form_head)
     if template:
-        html_form += template['DESCRIPTION'].replace('<br />', '\n')
-    html_form += '</textarea><br />'
+        html_parts.append(template['DESCRIPTION'].replace('<br />', '\n'))
+    html_parts.append('</textarea><br />')
 
     soft_list = []
     if software_entries > 0:
-        html_form += '<br /><b>Needed Software:</b><br />'
+        html_parts.append('<br /><b>Needed Software:</b><br />')
     if template:
         if 'SOFTWARE' in template:
             soft_list = template['SOFTWARE']
             for soft in soft_list:
-                html_form += """
-<textarea class='p80width' rows='6' name='software'>"""
-                for keyname in soft:
-                    if keyname != '':
-                        html_form += '%s=%s\n' % (keyname, soft[keyname])
-                html_form += '</textarea><br />'
+                html_parts.append(_software_area)
+                html_parts.append(''.join(['%s=%s\n' % (keyname, soft[keyname])
+                                           for keyname in soft
+                                           if keyname != '']))
+                html_parts.append('</textarea><br />')
 
     # loop and create textareas for any missing software entries
 
@@ -266,71 +338,43 @@ information.'''
         sublevel_required = software['Sublevel_required']
         sublevel_optional = software['Sublevel_optional']
 
-    for _ in range(len(soft_list), software_entries):
-        html_form += """
-<textarea class='p80width' rows='6' name='software'>"""
-        for sub_req in sublevel_required:
-            html_form += '%s=   # required\n' % sub_req
-        for sub_opt in sublevel_optional:
-            html_form += '%s=   # optional\n' % sub_opt
-        html_form += '</textarea><br />'
+    # NOTE: the empty entries are all identical so just build one of them
+    soft_entry = [_software_area]
+    soft_entry += ['%s=   # required\n' % i for i in sublevel_required]
+    soft_entry += ['%s=   # optional\n' % i for i in sublevel_optional]
+    soft_entry.append('</textarea><br />')
+    missing_entries = max(0, software_entries - len(soft_list))
+    html_parts += [''.join(soft_entry)] * missing_entries
 
     if template and testprocedure_entry == 1:
         if 'TESTPROCEDURE' in template:
-            html_form += """
-<br /><b>Testprocedure</b> (in mRSL format):<br />
-<textarea class='p80width' rows='15' name='testprocedure'>"""
+            html_parts.append(_testprocedure_area)
 
-            base64string = ''
-            for stringpart in template['TESTPROCEDURE']:
-                base64string += stringpart
-                decodedstring = base64.decodestring(base64string)
-                html_form += decodedstring
-            html_form += '</textarea>'
+            # NOTE: testprocedure is stored base64 encoded in parts
+            base64string = ''.join(template['TESTPROCEDURE'])
+            html_parts.append(force_native_str(base64.b64decode(base64string)))
+            html_parts.append('</textarea>')
             output_objects.append(
-                {'object_type': 'html_form', 'text': html_form})
+                {'object_type': 'html_form', 'text': ''.join(html_parts)})
 
-            html_form = """
-<br /><b>Expected .stdout file if testprocedure is executed</b><br />
-<textarea class='p80width' rows='10' name='verifystdout'>"""
+            html_parts = [_verifystdout_area]
 
             if 'VERIFYSTDOUT' in template:
-                for line in template['VERIFYSTDOUT']:
-                    html_form += line
-            html_form += '</textarea>'
+                html_parts += template['VERIFYSTDOUT']
+            html_parts.append('</textarea>')
 
-            html_form += """
-<br /><b>Expected .stderr file if testprocedure is executed</b><br />
-<textarea cols='50' rows='10' name='verifystderr'>"""
+            html_parts.append(_verifystderr_area)
             if 'VERIFYSTDERR' in template:
-                for line in template['VERIFYSTDERR']:
-                    html_form += line
-            html_form += '</textarea>'
+                html_parts += template['VERIFYSTDERR']
+            html_parts.append('</textarea>')
 
-            html_form += """
-<br /><b>Expected .status file if testprocedure is executed</b><br />
-<textarea cols='50' rows='10' name='verifystatus'>"""
+            html_parts.append(_verifystatus_area)
             if 'VERIFYSTATUS' in template:
-                for line in template['VERIFYSTATUS']:
-                    html_form += line
-            html_form += '</textarea>'
+                html_parts += template['VERIFYSTATUS']
+            html_parts.append('</textarea>')
     elif testprocedure_entry == 1:
-
-        html_form += """
-<br /><b>Testprocedure</b> (in mRSL format):<br />
-<textarea class='p80width' rows='15' name='testprocedure'>"""
-
-        html_form += \
-            """::EXECUTE::
-ls    
-</textarea>
-<br /><b>Expected .stdout file if testprocedure is executed</b><br />
-<textarea class='p80width' rows='10' name='verifystdout'></textarea>
-<br /><b>Expected .stderr file if testprocedure is executed</b><br />
-<textarea class='p80width' rows='10' name='verifystderr'></textarea>
-<br /><b>Expected .status file if testprocedure is executed</b><br />
-<textarea class='p80width' rows='10' name='verifystatus'></textarea>
-"""
+        html_parts.append(_testprocedure_area)
+        html_parts.append(_default_testprocedure)
 
     environmentvariable = rekeywords_dict['ENVIRONMENTVARIABLE']
     sublevel_required = []
@@ -343,32 +387,27 @@ ls
 
     env_list = []
     if environment_entries > 0:
-        html_form += '<br /><b>Environments:</b><br />'
+        html_parts.append('<br /><b>Environments:</b><br />')
     if template:
         if 'ENVIRONMENTVARIABLE' in template:
             env_list = template['ENVIRONMENTVARIABLE']
             for env in env_list:
-                html_form += """
-<textarea class='p80width' rows='4' name='environment'>"""
-                for keyname in env:
-                    if keyname != '':
-                        html_form += '%s=%s\n' % (keyname, env[keyname])
-                html_form += '</textarea><br />'
+                html_parts.append(_environment_area)
+                html_parts.append(''.join(['%s=%s\n' % (keyname, env[keyname])
+                                           for keyname in env
+                                           if keyname != '']))
+                html_parts.append('</textarea><br />')
 
     # loop and create textareas for any missing environment entries
 
-    for _ in range(len(env_list), environment_entries):
-        html_form += """
-<textarea class='p80width' rows='4' name='environment'>"""
-        for sub_req in sublevel_required:
-            html_form += '%s=   # required\n' % sub_req
-        for sub_opt in sublevel_optional:
-            html_form += '%s=   # optional\n' % sub_opt
-        html_form += '</textarea><br />'
+    env_entry = [_environment_area]
+    env_entry += ['%s=   # required\n' % i for i in sublevel_required]
+    env_entry += ['%s=   # optional\n' % i for i in sublevel_optional]
+    env_entry.append('</textarea><br />')
+    missing_entries = max(0, environment_entries - len(env_list))
+    html_parts += [''.join(env_entry)] * missing_entries
 
-    html_form += """<br /><br /><input type='submit' value='Create' />
-    </form>
-"""
+    html_parts.append(_create_form_tail)
     output_objects.append({'object_type': 'html_form', 'text':
-                           html_form % fill_helpers})
+                           ''.join(html_parts) % fill_helpers})
     return (output_objects, returnvalues.OK)
@@ -29,6 +29,7 @@
 
 from __future__ import absolute_import
 
+import errno
 import os
 
 from mig.shared import returnvalues
@@ -80,6 +81,8 @@ def main(client_id, user_arguments_dict, environ=None):
         return (accepted, returnvalues.CLIENT_ERROR)
 
     flags = ''.join(accepted['flags'])
+    # NOTE: flags are fixed for the request so only parse them once
+    make_parents, be_verbose = parents(flags), verbose(flags)
     patterns = accepted['path']
     current_dir = accepted['current_dir'][-1]
     share_id = accepted['share_id'][-1]
@@ -150,12 +153,14 @@ CSRF-filtered POST requests to prevent unintended updates'''
              'text': 'Invalid client/sharelink id!'})
         return (output_objects, returnvalues.CLIENT_ERROR)
 
-    if verbose(flags):
-        for flag in flags:
-            output_objects.append({'object_type': 'text',
-                                   'text': '%s using flag: %s'
-                                   % (op_name, flag)})
+    if be_verbose:
+        output_objects.append({'object_type': 'text',
+                               'text': '%s using flags: %s'
+                               % (op_name, ' '.join(flags))})
 
+    # NOTE: the path prefix is the same for all patterns
+    path_prefix = base_dir + os.sep + current_dir + os.sep
+    base_dir_len = len(base_dir)
     for pattern in patterns:
 
         # Check directory traversal attempts before actual handling to avoid
@@ -163,92 +168,103 @@ CSRF-filtered POST requests to prevent unintended updates'''
         # consistent error messages
         # NB: Globbing disabled on purpose here
 
-        unfiltered_match = [base_dir + os.sep + current_dir + os.sep
-                            + pattern]
-        match = []
-        for server_path in unfiltered_match:
-            # IMPORTANT: path must be expanded to abs for proper chrooting
-            abs_path = os.path.abspath(server_path)
-            if not valid_user_path(configuration, abs_path, base_dir, True):
-
-                # out of bounds - save user warning for later to allow
-                # partial match:
-                # ../*/* is technically allowed to match own files.
-
-                logger.warn('%s tried to %s %s restricted path! (%s)'
-                            % (client_id, op_name, abs_path, pattern))
-                continue
-            match.append(abs_path)
-
-        # Now actually treat list of allowed matchings and notify if no
-        # (allowed) match
-
-        if not match:
+        # IMPORTANT: path must be expanded to abs for proper chrooting
+        # NOTE: base_dir is already absolute so plain normpath suffices
+        #       and avoids the getcwd call in abspath
+        abs_path = os.path.normpath(path_prefix + pattern)
+        if not valid_user_path(configuration, abs_path, base_dir, True):
+            logger.warn('%s tried to %s %s restricted path! (%s)',
+                        client_id, op_name, abs_path, pattern)
             output_objects.append(
                 {'object_type': 'error_text',
                  'text': "%s: cannot create directory '%s': Permission denied"
                  % (op_name, pattern)})
             status = returnvalues.CLIENT_ERROR
+            continue
 
-        for abs_path in match:
-            relative_path = abs_path.replace(base_dir, '')
-            if verbose(flags):
-                output_objects.append(
-                    {'object_type': 'file', 'name': relative_path})
-            if not parents(flags) and os.path.exists(abs_path):
-                output_objects.append({'object_type': 'error_text',
-                                       'text': '%s: path exist!' % pattern})
-                status = returnvalues.CLIENT_ERROR
-                continue
-            if not check_write_access(abs_path, parent_dir=True):
-                logger.warning('%s called without write access: %s'
-                               % (op_name, abs_path))
-                output_objects.append(
-                    {'object_type': 'error_text', 'text':
-                     'cannot create "%s": inside a read-only location!'
-                     % pattern})
-                status = returnvalues.CLIENT_ERROR
-                continue
-            try:
+        # NOTE: abs_path is inside base_dir so a slice is enough
+        if abs_path.startswith(base_dir):
+            relative_path = abs_path[base_dir_len:]
+        else:
+            relative_path = abs_path
+        if be_verbose:
+            output_objects.append(
+                {'object_type': 'file', 'name': relative_path})
+        # NOTE: check existence before write access and GDP io-log so that
+        #       users get the right error and no bogus created entries
+        if not make_parents and os.path.exists(abs_path):
+            output_objects.append({'object_type': 'error_text',
+                                   'text': '%s: path exist!' % pattern})
+            status = returnvalues.CLIENT_ERROR
+            continue
+        if not check_write_access(abs_path, parent_dir=True):
+            logger.warning('%s called without write access: %s'
+                           % (op_name, abs_path))
+            output_objects.append(
+                {'object_type': 'error_text', 'text':
+                 'cannot create "%s": inside a read-only location!'
+                 % pattern})
+            status = returnvalues.CLIENT_ERROR
+            continue
+        try:
+            gdp_iolog(configuration,
+                      client_id,
+                      environ['REMOTE_ADDR'],
+                      'created',
+                      [relative_path])
+            # NOTE: EEXIST from the actual mkdir still covers any race
+            #       with a path created after the exists check above
+            if make_parents:
+                # NOTE: try plain mkdir first as the parent usually
+                #       exists and only walk up with makedirs if not
+                try:
+                    try:
+                        os.mkdir(abs_path)
+                    except OSError as exc:
+                        if exc.errno != errno.ENOENT:
+                            raise
+                        os.makedirs(abs_path)
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST or \
+                            not os.path.isdir(abs_path):
+                        raise
+            else:
+                os.mkdir(abs_path)
+            logger.info('%s %s done' % (op_name, abs_path))
+        except Exception as exc:
+            if not isinstance(exc, GDPIOLogError):
                 gdp_iolog(configuration,
                           client_id,
                           environ['REMOTE_ADDR'],
                           'created',
-                          [relative_path])
-                if parents(flags):
-                    if not os.path.isdir(abs_path):
-                        os.makedirs(abs_path)
-                else:
-                    os.mkdir(abs_path)
-                logger.info('%s %s done' % (op_name, abs_path))
-            except Exception as exc:
-                if not isinstance(exc, GDPIOLogError):
-                    gdp_iolog(configuration,
-                              client_id,
-                              environ['REMOTE_ADDR'],
-                              'created',
-                              [relative_path],
-                              failed=True,
-                              details=exc)
+                          [relative_path],
+                          failed=True,
+                          details=exc)
+            if getattr(exc, 'errno', None) == errno.EEXIST:
                 output_objects.append({'object_type': 'error_text',
-                                       'text': "%s: '%s' failed!"
-                                       % (op_name, relative_path)})
-                logger.error("%s: failed on '%s': %s" % (op_name,
-                                                         relative_path, exc))
-
-                status = returnvalues.SYSTEM_ERROR
+                                       'text': '%s: path exist!'
+                                       % pattern})
+                status = returnvalues.CLIENT_ERROR
                 continue
-            output_objects.append({'object_type': 'text',
-                                   'text': "created directory %s"
-                                   % (relative_path)})
-            if id_query:
-                open_query = "%s;current_dir=%s" % (id_query, relative_path)
-            else:
-                open_query = "?current_dir=%s" % relative_path
-            output_objects.append({'object_type': 'link',
-                                   'destination': 'ls.py%s' % open_query,
-                                   'text': 'Open %s' % relative_path})
-            output_objects.append({'object_type': 'text', 'text': ''})
+            output_objects.append({'object_type': 'error_text',
+                                   'text': "%s: '%s' failed!"
+                                   % (op_name, relative_path)})
+            logger.error("%s: failed on '%s': %s", op_name,
+                         relative_path, exc)
+
+            status = returnvalues.SYSTEM_ERROR
+            continue
+        output_objects.append({'object_type': 'text',
+                               'text': "created directory %s"
+                               % (relative_path)})
+        if id_query:
+            open_query = "%s;current_dir=%s" % (id_query, relative_path)
+        else:
+            open_query = "?current_dir=%s" % relative_path
+        output_objects.append({'object_type': 'link',
+                               'destination': 'ls.py%s' % open_query,
+                               'text': 'Open %s' % relative_path})
+        output_objects.append({'object_type': 'text', 'text': ''})
 
     output_objects.append({'object_type': 'link',
                            'destination': 'ls.py%s' % id_query,
@@ -44,6 +44,8 @@ keyset.
 from __future__ import print_function
 from __future__ import absolute_import
 
+import hashlib
+import logging
 import os
 import re
 import socket
@@ -52,22 +54,65 @@ import time
 import shutil
 import random
 import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 
 from mig.shared import returnvalues
-from mig.shared.base import client_id_dir, extract_field
+from mig.shared.base import client_id_dir, extract_field, force_native_str, \
+    force_utf8, hexlify
 from mig.shared.defaults import session_id_bytes
-from mig.shared.fileio import make_symlink, pickle, unpickle, write_file, \
-    delete_symlink, delete_file
+from mig.shared.fileio import make_symlink, write_file, \
+    delete_symlink, delete_file, listdir, scandir, makedirs_rec
 from mig.shared.functional import validate_input_and_cert, REJECT_UNSET
 from mig.shared.httpsclient import unescape
 from mig.shared.init import initialize_main_variables
-from mig.shared.pwcrypto import generate_random_ascii
+from mig.shared.jupyter import load_jupyter_mount_state, \
+    save_jupyter_mount_state
 from mig.shared.ssh import generate_ssh_rsa_key_pair, tighten_key_perms
 from mig.shared.workflows import create_workflow_session_id, \
     get_workflow_session_id
 
+# Seconds until a jupyter mount keyset expires
+mount_timeout = 7200
+# Seconds to wait for a jupyter host to respond
+request_timeout = 30
+# Seconds to trust a successful host probe before probing it again
+healthy_ttl = 30
+
+# Map probed host URLs to the time they last answered
+_healthy_hosts = {}
+# Options restricting what the subsys sftp mount keys can be used for
+mount_restrictions = 'no-agent-forwarding,no-port-forwarding,no-pty,' \
+    'no-user-rc,no-X11-forwarding'
+# Seconds to keep the resolved sftp addresses
+sftp_address_ttl = 300
+
+_sftp_address_cache = {'value': None, 'expire': 0}
+
+# NOTE: the adapter holds the connection pool, which we share between
+#       requests in long-running processes to reuse the TLS sessions with the
+#       jupyter hosts. Cookies are per-session and carry the user login, so
+#       each request still gets a session of its own on top of the pool.
+_jupyter_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                               max_retries=0)
+
+
+@contextmanager
+def jupyter_session():
+    """Context manager providing a requests session with a private cookie jar
+    on top of the shared jupyter connection pool. Unlike a plain session
+    context it must not close the adapter on exit as that drops the pool.
+    """
+    session = requests.Session()
+    session.mount('https://', _jupyter_adapter)
+    session.mount('http://', _jupyter_adapter)
+    try:
+        yield session
+    finally:
+        session.cookies.clear()
+
 
-def is_active(pickle_state, timeout=7200):
+def is_active(pickle_state, timeout=mount_timeout):
     """
     :param pickle_state: expects a pickle object dictionary that
     contains the field 'CREATED_TIMESTAMP' with a timestamp of when the pickle
@@ -130,6 +175,24 @@ def mig_to_mount_adapt(mig):
     return mount
 
 
+def redact_mount(mount):
+    """
+    :param mount: a mount dictionary as returned from mig_to_mount_adapt
+    :return: a copy of mount with the private key replaced for logging
+    """
+    redacted = dict(mount)
+    redacted['privateKey'] = '<redacted>'
+    return redacted
+
+
+def key_fingerprint(public_key):
+    """
+    :param public_key: an ssh public key string
+    :return: a short sha256 hex digest identifying public_key in logs
+    """
+    return hashlib.sha256(force_utf8(public_key)).hexdigest()[:16]
+
+
 def mig_to_user_adapt(mig):
     """
     :param mig: expects a dictionary containing a USER_CERT key that defines
@@ -162,54 +225,60 @@ def mig_to_workflows_adapt(mig):
 
 def remove_jupyter_mount(jupyter_mount_path, configuration):
     """
-    :param jupyter_mount_path path to a jupyter mount pickle state file
+    :param jupyter_mount_path path to a jupyter mount state file
     :param configuration the MiG configuration object
     :return: void
     """
 
     filename = os.path.basename(jupyter_mount_path)
+    session_id = filename.split('.jupyter_mount')[0]
     link_home = configuration.sessid_to_jupyter_mount_link_home
     # Remove jupyter mount session symlinks for the default sftp service
-    for link in os.listdir(link_home):
-        if link in filename:
-            delete_symlink(os.path.join(link_home, link),
-                           configuration.logger)
+    # NOTE: the state file and user home links are both named after the
+    #       session ID so we can target them directly without any listdir
+    for link in (filename, session_id):
+        delete_symlink(os.path.join(link_home, link), configuration.logger,
+                       allow_missing=True)
 
     # Remove subsys sftp files
     if configuration.site_enable_sftp_subsys:
         auth_dir = os.path.join(configuration.mig_system_files,
                                 'jupyter_mount')
-        for auth_file in os.listdir(auth_dir):
-            if auth_file.split('.authorized_keys')[0] in filename:
-                delete_file(os.path.join(auth_dir, auth_file),
-                            configuration.logger)
+        delete_file(os.path.join(auth_dir, session_id + '.authorized_keys'),
+                    configuration.logger, allow_missing=True)
 
-    # Remove old pickle state file
+    # Remove old state file
     delete_file(jupyter_mount_path, configuration.logger)
 
 
-def get_newest_mount(jupyter_mounts):
+def list_jupyter_mounts(mnt_path):
     """
-    Finds the most recent jupyter mount
-    :param jupyter_mounts: Expects a list of jupyter_mount
-    dictionaries. Furthermore that each dictionary has a state key that contains
-    the unpickled content of a jupyter state file.
-    :return: (newest_mount, [older_mounts]),
-    if jupyter_mounts is empty (None, []) is returned.
+    Lists the jupyter mount state files in mnt_path
+    :param mnt_path: the directory containing the jupyter mount state files
+    :return: list of (path, mtime) tuples for the state files
     """
-    if not jupyter_mounts:
-        return None, []
-
-    old_mounts = []
-    latest = jupyter_mounts.pop(0)
-    for mount in jupyter_mounts:
-        if int(latest['state']['CREATED_TIMESTAMP']) \
-                < int(mount['state']['CREATED_TIMESTAMP']):
-            old_mounts.append(latest)
-            latest = mount
-        else:
-            old_mounts.append(mount)
-    return latest, old_mounts
+    if scandir is not None:
+        # NOTE: scandir entries cache stat info from the directory read
+        return [(entry.path, entry.stat().st_mtime) for entry in
+                scandir(mnt_path) if entry.name.endswith('.jupyter_mount')]
+    mount_paths = [os.path.join(mnt_path, jfile) for jfile in
+                   listdir(mnt_path) if jfile.endswith('.jupyter_mount')]
+    return [(path, os.path.getmtime(path)) for path in mount_paths]
+
+
+def resolve_sftp_addresses(configuration):
+    """Resolve the sftp host addresses to show jupyter mounts. The lookup
+    result is cached for a while to avoid blocking on DNS for every login.
+    :param configuration: the MiG Configuration object
+    :return: the (hostname, aliaslist, ipaddrlist) tuple from gethostbyname_ex
+    """
+    now = time.time()
+    if _sftp_address_cache['value'] is None or \
+            now > _sftp_address_cache['expire']:
+        _sftp_address_cache['value'] = socket.gethostbyname_ex(
+            configuration.user_sftp_show_address or socket.getfqdn())
+        _sftp_address_cache['expire'] = now + sftp_address_ttl
+    return _sftp_address_cache['value']
 
 
 def get_host_from_service(configuration, service, base_url=None):
@@ -230,17 +299,22 @@ def get_host_from_service(configuration, service, base_url=None):
             rng = 0
         else:
             rng = random.randrange(0, len(hosts) - 1)
+        probe_url = hosts[rng]
+        if base_url:
+            probe_url += base_url
+        # Skip probe if the host recently answered
+        if time.time() - _healthy_hosts.get(probe_url, 0) < healthy_ttl:
+            return hosts[rng]
         try:
-            with requests.session() as session:
-                _logger.info("requsting url: %s%s" % (hosts[rng], base_url))
-                if base_url:
-                    session.get(hosts[rng] + base_url)
-                else:
-                    session.get(hosts[rng])
+            with jupyter_session() as session:
+                _logger.info("requsting url: %s" % probe_url)
+                session.get(probe_url, timeout=request_timeout)
+                _healthy_hosts[probe_url] = time.time()
                 return hosts[rng]
-        except requests.ConnectionError as err:
+        except (requests.ConnectionError, requests.Timeout) as err:
             _logger.error("Failed to establish connection to %s error %s" %
                           (hosts[rng], err))
+            _healthy_hosts.pop(probe_url, None)
             hosts.pop(rng)
     return None
 
@@ -420,15 +494,18 @@ def main(client_id, user_arguments_dict):
     user_home_dir = os.path.join(configuration.user_home, client_dir)
 
     # Preparing prerequisites
-    if not os.path.exists(mnt_path):
-        os.makedirs(mnt_path)
-
-    if not os.path.exists(link_home):
-        os.makedirs(link_home)
-
+    prepare_dirs = [mnt_path, link_home]
     if configuration.site_enable_sftp_subsys:
-        if not os.path.exists(subsys_path):
-            os.makedirs(subsys_path)
+        prepare_dirs.append(subsys_path)
+    for dir_path in prepare_dirs:
+        if not makedirs_rec(dir_path, configuration):
+            logger.error("Jupyter: failed to prepare %r for %s"
+                         % (dir_path, client_id))
+            output_objects.append(
+                {'object_type': 'error_text', 'text':
+                 'Failed to prepare the Jupyter service mount - please '
+                 'contact a system administrator about this issue'})
+            return (output_objects, returnvalues.SYSTEM_ERROR)
 
     # Make sure ssh daemon does not complain
     tighten_key_perms(configuration, client_id)
@@ -440,19 +517,29 @@ def main(client_id, user_arguments_dict):
 
     # Does the client home dir contain an active mount key
     # If so just keep on using it.
-    jupyter_mount_files = [os.path.join(mnt_path, jfile) for jfile in
-                           os.listdir(mnt_path)
-                           if jfile.endswith('.jupyter_mount')]
-
-    logger.info("User: %s mount files: %s"
-                % (client_id, "\n".join(jupyter_mount_files)))
-    logger.debug("Remote-User %s" % remote_user)
-    active_mounts = []
-    for jfile in jupyter_mount_files:
-        jupyter_dict = unpickle(jfile, logger)
+    jupyter_mount_files = list_jupyter_mounts(mnt_path)
+
+    # NOTE: skip building the potentially long file list string unless used
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("User: %s mount files: %s"
+                    % (client_id, "\n".join([jfile for (jfile, _) in
+                                             jupyter_mount_files])))
+    logger.debug("Remote-User %s", remote_user)
+    active_mount = None
+    now = time.time()
+    # NOTE: newest first so that the first active mount is the one to keep
+    #       and any older ones can be removed without loading them at all
+    jupyter_mount_files.sort(key=lambda entry: entry[1], reverse=True)
+    for (jfile, mtime) in jupyter_mount_files:
+        # NOTE: state files are written once on creation so an old mtime
+        #       reveals a timed out mount without the need to load it
+        if active_mount is not None or now - mtime > mount_timeout:
+            remove_jupyter_mount(jfile, configuration)
+            continue
+        jupyter_dict = load_jupyter_mount_state(jfile, logger)
         if not jupyter_dict:
-            # Remove failed unpickle
-            logger.error("Failed to unpickle %s removing it" % jfile)
+            # Remove failed load
+            logger.error("Failed to load %s removing it" % jfile)
             remove_jupyter_mount(jfile, configuration)
         else:
             # Mount has been timed out
@@ -460,24 +547,16 @@ def main(client_id, user_arguments_dict):
                 remove_jupyter_mount(jfile, configuration)
             else:
                 # Valid mount
-                active_mounts.append({'path': jfile, 'state': jupyter_dict})
-
-    logger.debug("User: %s active keys: %s" %
-                 (client_id,
-                  "\n".join([mount['path'] for mount in active_mounts])))
-
-    # If multiple are active, remove oldest
-    active_mount, old_mounts = get_newest_mount(active_mounts)
-    for mount in old_mounts:
-        remove_jupyter_mount(mount['path'], configuration)
+                active_mount = {'path': jfile, 'state': jupyter_dict}
+                logger.debug("User: %s active key: %s", client_id, jfile)
 
     # A valid active key is already present redirect straight to the jupyter
     # service, pass most recent mount information
     if active_mount is not None:
         mount_dict = mig_to_mount_adapt(active_mount['state'])
         user_dict = mig_to_user_adapt(active_mount['state'])
-        logger.debug("Existing header values, Mount: %s User: %s"
-                     % (mount_dict, user_dict))
+        logger.debug("Existing header values, Mount: %s User: %s",
+                     redact_mount(mount_dict), user_dict)
 
         auth_header = {'Remote-User': remote_user}
         user_post_data = {
@@ -506,17 +585,22 @@ def main(client_id, user_arguments_dict):
                          % workflows_dict)
             user_post_data['workflows_data'] = {'Session': workflows_dict}
 
-        with requests.session() as session:
+        with jupyter_session() as session:
             # Refresh cookies
-            session.get(url_auth)
+            session.get(url_auth, timeout=request_timeout)
             auth_params = {}
             if "_xsrf" in session.cookies:
                 auth_params = {"_xsrf": session.cookies['_xsrf']}
             # Authenticate and submit data
-            response = session.post(url_auth, headers=auth_header, params=auth_params)
+            response = session.post(url_auth, headers=auth_header,
+                                    params=auth_params,
+                                    timeout=request_timeout)
             if response.status_code == 200:
                 for user_data_type, user_data in user_post_data.items():
-                    response = session.post(url_data, json={user_data_type: user_data}, params=auth_params)
+                    response = session.post(url_data,
+                                            json={user_data_type: user_data},
+                                            params=auth_params,
+                                            timeout=request_timeout)
                     if response.status_code != 200:
                         logger.error(
                             "Jupyter: User %s failed to submit data %s to %s"
@@ -532,33 +616,29 @@ def main(client_id, user_arguments_dict):
 
     # Create a new keyset
     # Create login session id
-    session_id = generate_random_ascii(2*session_id_bytes,
-                                       charset='0123456789abcdef')
+    session_id = force_native_str(hexlify(os.urandom(session_id_bytes)))
 
     # Generate private/public keys
     (mount_private_key, mount_public_key) = generate_ssh_rsa_key_pair(
         encode_utf8=True)
 
     # Known hosts
-    sftp_addresses = socket.gethostbyname_ex(
-        configuration.user_sftp_show_address or socket.getfqdn())
+    sftp_addresses = resolve_sftp_addresses(configuration)
 
     # Subsys sftp support
     if configuration.site_enable_sftp_subsys:
         # Restrict possible mount agent
-        auth_content = []
-        restrict_opts = 'no-agent-forwarding,no-port-forwarding,no-pty,'
-        restrict_opts += 'no-user-rc,no-X11-forwarding'
-        restrictions = '%s' % restrict_opts
-        auth_content.append('%s %s\n' % (restrictions, mount_public_key))
+        auth_line = '%s %s\n' % (mount_restrictions, mount_public_key)
         # Write auth file
-        write_file('\n'.join(auth_content),
-                   os.path.join(subsys_path, session_id
-                                + '.authorized_keys'), logger, umask=0o27)
+        write_file(auth_line, os.path.join(subsys_path, session_id
+                                           + '.authorized_keys'),
+                   logger, umask=0o027)
 
-    logger.debug("User: %s - Creating a new jupyter mount keyset - "
-                 "private_key: %s public_key: %s "
-                 % (client_id, mount_private_key, mount_public_key))
+    # NOTE: never log the actual key material
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("User: %s - Creating a new jupyter mount keyset - "
+                     "public key fingerprint: %s"
+                     % (client_id, key_fingerprint(mount_public_key)))
 
     jupyter_dict = {
         'MOUNT_HOST': configuration.short_title,
@@ -595,11 +675,13 @@ def main(client_id, user_arguments_dict):
     mount_dict = mig_to_mount_adapt(jupyter_dict)
     user_dict = mig_to_user_adapt(jupyter_dict)
     workflows_dict = mig_to_workflows_adapt(jupyter_dict)
-    logger.debug("User: %s Mount header: %s" % (client_id, mount_dict))
-    logger.debug("User: %s User header: %s" % (client_id, user_dict))
-    if workflows_dict:
-        logger.debug("User: %s Workflows header: %s" % (client_id,
-                                                        workflows_dict))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("User: %s Mount header: %s" %
+                     (client_id, redact_mount(mount_dict)))
+        logger.debug("User: %s User header: %s" % (client_id, user_dict))
+        if workflows_dict:
+            logger.debug("User: %s Workflows header: %s" % (client_id,
+                                                            workflows_dict))
 
     # Auth and pass a new set of valid mount keys
     auth_header = {'Remote-User': remote_user}
@@ -612,17 +694,21 @@ def main(client_id, user_arguments_dict):
         user_post_data['workflows_data'] = {'Session': workflows_dict}
 
     # First login
-    with requests.session() as session:
+    with jupyter_session() as session:
         # Refresh cookies
-        session.get(url_auth)
+        session.get(url_auth, timeout=request_timeout)
         auth_params = {}
         if "_xsrf" in session.cookies:
             auth_params = {"_xsrf": session.cookies['_xsrf']}
         # Authenticate
-        response = session.post(url_auth, headers=auth_header, params=auth_params)
+        response = session.post(url_auth, headers=auth_header,
+                                params=auth_params, timeout=request_timeout)
         if response.status_code == 200:
             for user_data_type, user_data in user_post_data.items():
-                response = session.post(url_data, json={user_data_type: user_data}, params=auth_params)
+                response = session.post(url_data,
+                                        json={user_data_type: user_data},
+                                        params=auth_params,
+                                        timeout=request_timeout)
                 if response.status_code != 200:
                     logger.error("Jupyter: User %s failed to submit data %s to %s"
                                 % (client_id, user_data, url_data))
@@ -630,19 +716,23 @@ def main(client_id, user_arguments_dict):
             logger.error("Jupyter: User %s failed to authenticate against %s"
                          % (client_id, url_auth))
 
-    # Update pickle with the new valid key
-    jupyter_mount_state_path = os.path.join(mnt_path,
-                                            session_id + '.jupyter_mount')
-
-    pickle(jupyter_dict, jupyter_mount_state_path, logger)
+    # Update state with the new valid key
+    state_name = session_id + '.jupyter_mount'
+    jupyter_mount_state_path = os.path.join(mnt_path, state_name)
 
-    # Link jupyter pickle state file
-    linkdest_new_jupyter_mount = os.path.join(mnt_path,
-                                              session_id + '.jupyter_mount')
+    if not save_jupyter_mount_state(jupyter_dict, jupyter_mount_state_path,
+                                    logger):
+        logger.error("Jupyter: failed to save mount state for %s in %r"
+                     % (client_id, jupyter_mount_state_path))
+        output_objects.append(
+            {'object_type': 'error_text', 'text':
+             'Failed to save the Jupyter service mount state - please '
+             'contact a system administrator about this issue'})
+        return (output_objects, returnvalues.SYSTEM_ERROR)
 
-    linkloc_new_jupyter_mount = os.path.join(link_home,
-                                             session_id + '.jupyter_mount')
-    make_symlink(linkdest_new_jupyter_mount, linkloc_new_jupyter_mount, logger)
+    # Link jupyter state file
+    linkloc_new_jupyter_mount = os.path.join(link_home, state_name)
+    make_symlink(jupyter_mount_state_path, linkloc_new_jupyter_mount, logger)
 
     # Link userhome
     linkloc_user_home = os.path.join(link_home, session_id)
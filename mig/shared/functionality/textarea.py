@@ -33,6 +33,7 @@
 from __future__ import absolute_import
 
 import base64
+import errno
 import os
 import time
 
@@ -48,6 +49,10 @@ from mig.shared.job import new_job
 from mig.shared.safeinput import valid_user_path_name
 from mig.shared.archives import handle_package_upload
 
+# NOTE: lowercase suffixes for case-insensitive endswith checks
+mrsl_suffix = '.mrsl'
+package_suffixes = ('.zip', '.tar.gz', '.tgz', '.tar.bz2')
+
 
 def signature():
     """Signature of the main function"""
@@ -63,39 +68,72 @@ def convert_control_value_to_line(form_key, user_arguments_dict):
     return value
 
 
-def handle_form_input(filenumber, user_arguments_dict, configuration):
-    """Get keyword_FILENUMBER_X_Y from form and put it in mRSL format
-    or write plain file
-    """
-
-    file_type = ''
+def get_form_keywords(configuration):
+    """Get the list of keywords to look for in the form"""
 
-    output = ''
     keys = list(mrslkeywords.get_keywords_dict(configuration))
 
     # FILE keyword used to indicate a plain file should be created
 
     keys.append('PLAINFILE')
     keys.append('FILEUPLOAD')
+    return keys
+
+
+def handle_form_input(filenumber, user_arguments_dict, configuration,
+                      keys=None):
+    """Get keyword_FILENUMBER_X_Y from form and put it in mRSL format
+    or write plain file. The optional keys list from get_form_keywords can be
+    passed to avoid building it again for every filenumber.
+    """
+
+    file_type = ''
+
+    output_parts = []
+    if keys is None:
+        keys = get_form_keywords(configuration)
+
+    # NOTE: scan the form once and bucket the keyword_FILENUMBER_X_Y cells
+    #       present for each keyword rather than formatting and probing
+    #       candidate keys for every single keyword.
+    lower_keys = dict([(keyword.lower(), keyword) for keyword in keys])
+    file_suffix = '%s' % filenumber
+    keyword_cells = {}
+    for form_key in user_arguments_dict:
+        parts = form_key.rsplit('_', 3)
+        if len(parts) != 4 or parts[1] != file_suffix or \
+                parts[0] not in lower_keys:
+            continue
+        try:
+            cell = (int(parts[2]), int(parts[3]))
+        except ValueError:
+            continue
+        # Only accept the plain integer format we look up below
+        if '%d_%d' % cell != '%s_%s' % (parts[2], parts[3]):
+            continue
+        cells = keyword_cells.setdefault(lower_keys[parts[0]], {})
+        cells[cell] = form_key
+
     for keyword in keys:
+        if keyword not in keyword_cells:
+            continue
+        cells = keyword_cells[keyword]
         counter_1 = -1
         counter_2 = 0
         end_with_newline = False
 
         while True:
-            form_key = '%s_%s_%s_%s' % (keyword.lower(), filenumber,
-                                        counter_1, counter_2 + 1)
-            form_key_line = '%s_%s_%s_%s' % (keyword.lower(),
-                                             filenumber, counter_1 + 1, counter_2)
+            form_key = cells.get((counter_1, counter_2 + 1), None)
+            form_key_line = cells.get((counter_1 + 1, counter_2), None)
 
-            if form_key in user_arguments_dict:
+            if form_key is not None:
 
                 # Y increased, append value
 
-                output += convert_control_value_to_line(form_key,
-                                                        user_arguments_dict)
+                output_parts.append(convert_control_value_to_line(
+                    form_key, user_arguments_dict))
                 counter_2 += 1
-            elif form_key_line in user_arguments_dict:
+            elif form_key_line is not None:
 
                 # X increased. If 0_0 write keyword. Write new line.
 
@@ -108,12 +146,11 @@ def handle_form_input(filenumber, user_arguments_dict, configuration):
 
                         # write keyword the first time only
 
-                        output += '::%s::\n' % keyword
+                        output_parts.append('::%s::\n' % keyword)
                         end_with_newline = True
 
-                output += '%s\n'\
-                    % convert_control_value_to_line(form_key_line,
-                                                    user_arguments_dict)
+                output_parts.append('%s\n' % convert_control_value_to_line(
+                    form_key_line, user_arguments_dict))
                 counter_1 += 1
                 counter_2 = 0
             else:
@@ -121,10 +158,10 @@ def handle_form_input(filenumber, user_arguments_dict, configuration):
                 # X+1 or Y+1 not found, append newline if requested
 
                 if end_with_newline:
-                    output += '\n'
+                    output_parts.append('\n')
                 break
 
-    return (output, file_type)
+    return (''.join(output_parts), file_type)
 
 
 def main(client_id, user_arguments_dict):
@@ -178,9 +215,14 @@ CSRF-filtered POST requests to prevent unintended updates'''
                                             client_dir)) + os.sep
 
     mrsl = ''
+    form_keywords = get_form_keywords(configuration)
+    html_generated_mrsl_dir = base_dir + 'html_generated_mrsl'
+    mrsl_dir_ready = False
     while True:
         (content, file_type) = handle_form_input(filenumber,
-                                                 user_arguments_dict, configuration)
+                                                 user_arguments_dict,
+                                                 configuration,
+                                                 form_keywords)
 
         if not content:
             if filenumber < file_fields:
@@ -198,10 +240,9 @@ CSRF-filtered POST requests to prevent unintended updates'''
 
         try:
             mrsl = user_arguments_dict['mrsltextarea_%s' % filenumber][0]
-            content += mrsl
+            content = ''.join([content, mrsl, '\n'])
         except:
-            pass
-        content += '\n'
+            content += '\n'
 
         mrslfiles_to_parse = []
         submit_mrslfiles = False
@@ -269,7 +310,7 @@ CSRF-filtered POST requests to prevent unintended updates'''
                 + convert_control_value_to_line(filename_key,
                                                 user_arguments_dict)
 
-            if local_filename.upper().endswith('.MRSL')\
+            if local_filename.lower().endswith(mrsl_suffix)\
                     and submit_mrslfiles:
                 mrslfiles_to_parse.append(local_filename)
         elif file_type == 'fileupload':
@@ -339,7 +380,8 @@ CSRF-filtered POST requests to prevent unintended updates'''
                                        'text': 'File content not found!'})
                 return (output_objects, returnvalues.CLIENT_ERROR)
 
-            local_filename = os.path.abspath(base_dir + remote_filename)
+            # NOTE: base_dir is absolute so normpath is enough to expand
+            local_filename = os.path.normpath(base_dir + remote_filename)
             valid_status, valid_err = valid_user_path_name(remote_filename,
                                                            local_filename,
                                                            base_dir)
@@ -362,16 +404,20 @@ CSRF-filtered POST requests to prevent unintended updates'''
 
             encoded_key = '%s_is_encoded' % fileupload_key
             binary = encoded_key in user_arguments_dict
+            write_mode = 'w'
             if binary:
-                data = user_arguments_dict[fileupload_key][-1]
-                data = "%s" % base64.decodestring(data)
+                # NOTE: decode straight to the raw bytes without the extra
+                #       string copy and write those in binary mode
+                data = base64.b64decode(user_arguments_dict[fileupload_key][-1])
+                write_mode = 'wb'
             else:
                 data = user_arguments_dict[fileupload_key][-1]
 
             # write file in memory to disk
 
-            if not write_file(data, local_filename,
-                              configuration.logger):
+            # NOTE: parent dir was handled above so skip the extra check
+            if not write_file(data, local_filename, configuration.logger,
+                              mode=write_mode, make_parent=False):
                 logger.error("%s failed to write upload file %s" %
                              (op_name, local_filename))
                 output_objects.append(
@@ -401,10 +447,7 @@ CSRF-filtered POST requests to prevent unintended updates'''
             # handle file package
 
             if extract_packages\
-                and (local_filename.upper().endswith('.ZIP')
-                     or local_filename.upper().endswith('.TAR.GZ')
-                     or local_filename.upper().endswith('.TGZ')
-                     or local_filename.upper().endswith('.TAR.BZ2')):
+                    and local_filename.lower().endswith(package_suffixes):
                 (upload_status, msg) = handle_package_upload(
                     local_filename, remote_filename, client_id, configuration,
                     submit_mrslfiles, os.path.dirname(local_filename))
@@ -454,7 +497,7 @@ CSRF-filtered POST requests to prevent unintended updates'''
 
             # Check if the extension is .mRSL
 
-            if local_filename.upper().endswith('.MRSL')\
+            if local_filename.lower().endswith(mrsl_suffix)\
                     and submit_mrslfiles:
 
                 # A .mrsl file was uploaded!
@@ -465,45 +508,67 @@ CSRF-filtered POST requests to prevent unintended updates'''
                 mrslfiles_to_parse.append(local_filename)
         else:
 
-            # mrsl file created by html controls. create filename. Loop until
-            # a filename that do not exits is created
+            # mrsl file created by html controls. create a unique filename.
 
-            html_generated_mrsl_dir = base_dir + 'html_generated_mrsl'
-            if os.path.exists(html_generated_mrsl_dir)\
-                    and not os.path.isdir(html_generated_mrsl_dir):
-
-                # oops, user might have created a file with the same name
-
-                output_objects.append(
-                    {'object_type': 'error_text', 'text':
-                     'Please make sure %s does not exist or is a directory!'
-                     % 'html_generated_mrsl/'})
-                return (output_objects, returnvalues.CLIENT_ERROR)
-            if not os.path.isdir(html_generated_mrsl_dir):
-                os.mkdir(html_generated_mrsl_dir)
-            while True:
-                time_c = time.gmtime()
-                timestamp = '%s_%s_%s__%s_%s_%s' % (
-                    time_c[1],
-                    time_c[2],
-                    time_c[0],
-                    time_c[3],
-                    time_c[4],
-                    time_c[5],
-                )
-                rel_local_filename = 'TextAreaAt_' + timestamp + '.mRSL'
-                local_filename = os.path.join(html_generated_mrsl_dir,
-                                              rel_local_filename)
-                if not os.path.isfile(local_filename):
-                    break
-            # A new filename was created, write content to file
-
-            if not write_file(content, local_filename, logger):
-                logger.error("%s failed to write job file %r" %
-                             (op_name, local_filename))
+            # NOTE: only prepare the dir once per request and just try to
+            #       create it rather than stat'ing it up front
+            if not mrsl_dir_ready:
+                try:
+                    os.mkdir(html_generated_mrsl_dir)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                    if not os.path.isdir(html_generated_mrsl_dir):
+
+                        # oops, user might have created a file with the same
+                        # name
+
+                        output_objects.append(
+                            {'object_type': 'error_text', 'text':
+                             'Please make sure %s does not exist or is a '
+                             'directory!' % 'html_generated_mrsl/'})
+                        return (output_objects, returnvalues.CLIENT_ERROR)
+                mrsl_dir_ready = True
+            time_c = time.gmtime()
+            timestamp = '%s_%s_%s__%s_%s_%s' % (
+                time_c[1],
+                time_c[2],
+                time_c[0],
+                time_c[3],
+                time_c[4],
+                time_c[5],
+            )
+            # NOTE: exclusive create atomically claims a new unique file so
+            #       there is no need to spin until the timestamp changes. We
+            #       just add a counter on name clashes. The 0666 mode leaves
+            #       the final permissions to the umask like a plain open.
+            try:
+                name_index = 0
+                while True:
+                    if name_index:
+                        rel_local_filename = 'TextAreaAt_%s_%d.mRSL' % \
+                                             (timestamp, name_index)
+                    else:
+                        rel_local_filename = 'TextAreaAt_%s.mRSL' % timestamp
+                    local_filename = os.path.join(html_generated_mrsl_dir,
+                                                  rel_local_filename)
+                    try:
+                        mrsl_fd = os.open(local_filename, os.O_WRONLY |
+                                          os.O_CREAT | os.O_EXCL, 0o666)
+                        break
+                    except OSError as err:
+                        if err.errno != errno.EEXIST:
+                            raise
+                        name_index += 1
+                with os.fdopen(mrsl_fd, 'w') as mrsl_fh:
+                    mrsl_fh.write(content)
+            except Exception as err:
+                logger.error("%s failed to write job file in %r: %s" %
+                             (op_name, html_generated_mrsl_dir, err))
                 output_objects.append(
                     {'object_type': 'error_text',
-                     'text': 'Could not write: %s' % rel_local_filename})
+                     'text': 'Could not write new job file in: %s' %
+                     'html_generated_mrsl/'})
                 return (output_objects, returnvalues.SYSTEM_ERROR)
             fileuploadobj['name'] = os.path.join('', 'html_generated_mrsl',
                                                  rel_local_filename)
@@ -517,7 +582,10 @@ CSRF-filtered POST requests to prevent unintended updates'''
 
             # do not reveal full path of mrsl file to client
 
-            relative_filename = os.sep + mrslfile.replace(base_dir, '')
+            if mrslfile.startswith(base_dir):
+                relative_filename = os.sep + mrslfile[len(base_dir):]
+            else:
+                relative_filename = os.sep + mrslfile
             submitstatus = {'object_type': 'submitstatus',
                             'name': relative_filename}
 
@@ -41,8 +41,8 @@ import time
 
 from mig.shared import returnvalues
 from mig.shared.auth import twofactor_available, load_twofactor_key, \
-    get_twofactor_token, verify_twofactor_token, generate_session_key, \
-    save_twofactor_session, expire_twofactor_session
+    verify_twofactor_token, generate_session_key, save_twofactor_session, \
+    expire_twofactor_session
 from mig.shared.base import requested_backend, requested_page, extract_field, \
     verify_local_url
 from mig.shared.defaults import twofactor_cookie_ttl, AUTH_MIG_OID, \
@@ -56,7 +56,22 @@ from mig.shared.html import twofactor_token_html, themed_styles, themed_scripts
 from mig.shared.httpsclient import detect_client_auth, require_twofactor_setup
 from mig.shared.settings import load_twofactor
 from mig.shared.twofactorkeywords import get_keywords_dict as twofactor_defaults
-from mig.shared.url import urlencode, unquote, parse_qs
+from mig.shared.url import unquote, parse_qs
+
+# NOTE: the default 2FA values only depend on the configuration so we cache
+#       them on the configuration object itself. That ties the cache lifetime
+#       to the configuration and avoids any stale or ever growing global map.
+_twofactor_defaults_attr = '_twofactor_default_values'
+
+
+def twofactor_default_values(configuration):
+    """Get a dict mapping 2FA settings to their default values"""
+    default_values = getattr(configuration, _twofactor_defaults_attr, None)
+    if default_values is None:
+        default_values = dict([(i, j['Value']) for (i, j) in
+                               twofactor_defaults(configuration).items()])
+        setattr(configuration, _twofactor_defaults_attr, default_values)
+    return dict(default_values)
 
 
 def signature(configuration, setup_mode=False):
@@ -191,11 +206,16 @@ function update_reload_counter(cnt, delay) {
         for (key, val) in accepted.items():
             if key not in defaults and val != ['AllowMe']:
                 forward_args[key] = val
-        redirect_location = redirect_url
-        if forward_args:
-            redirect_location += '?%s' % urlencode(forward_args, True)
         # Manual url decoding required for e.g. slashes
-        redirect_location = unquote(redirect_location)
+        redirect_location = unquote(redirect_url)
+        if forward_args:
+            # NOTE: same result as unquote of the urlencoded args but without
+            #       the quote and unquote round-trip. Only the space to plus
+            #       translation of urlencode survives the unquote.
+            forward_query = '&'.join(['%s=%s' % (key, val) for (key, val_list)
+                                      in forward_args.items()
+                                      for val in val_list])
+            redirect_location += '?%s' % forward_query.replace(' ', '+')
         headers = [('Status', '302 Moved'),
                    ('Location', redirect_location)]
         logger.debug("redirect_url %s and args %s gave %s" %
@@ -208,8 +228,7 @@ function update_reload_counter(cnt, delay) {
                  (client_id, twofactor_dict))
     if not twofactor_dict:
         logger.warning("fall back to twofactor defaults for %s" % client_id)
-        twofactor_dict = dict([(i, j['Value']) for (i, j) in
-                               twofactor_defaults(configuration).items()])
+        twofactor_dict = twofactor_default_values(configuration)
 
     check_missing_setup = False
     # NOTE: twofactor_defaults field availability depends on configuration
@@ -368,10 +387,9 @@ with details.
             output_objects.append({'object_type': 'html_form', 'text':
                                    twofactor_token_html(configuration, support_html)})
             if token:
-                logger.warning('Invalid token for %s (%s vs %s) - try again' %
-                               (client_id, token,
-                                get_twofactor_token(configuration, client_id,
-                                                    b32_secret)))
+                # NOTE: never log the expected token - it is a live secret
+                logger.warning('Invalid token for %s (%s) - try again' %
+                               (client_id, token))
                 # NOTE: we keep actual result in plain text for json extract
                 output_objects.append({'object_type': 'html_form', 'text': '''
 <div class="twofactorresult">
@@ -27,7 +27,6 @@
 
 """ MiG daemon auth functions"""
 
-import time
 import re
 
 from mig.shared.auth import active_twofactor_session
@@ -432,23 +431,18 @@ fails to provide the correct credentials.
                 username, ip_addr, auth_msg, notify=notify)
 
     # Update and check rate limits
+    # If we hit max_secret_hits then a unique secret is added to force
+    # address, proto and user hits to increase
 
     (_, proto_hits, user_hits, secret_hits) = \
         update_rate_limit(configuration, protocol, ip_addr,
                           username, authorized,
-                          secret=secret)
-
-    # If we hit max_secret_hits then add a unique secret to force
-    # address, proto and user hits to increase
+                          secret=secret,
+                          max_secret_hits=max_secret_hits)
 
     if max_secret_hits > 0 and secret_hits > max_secret_hits:
         logger.debug("max secret hits reached: %d / %d" %
                      (secret_hits, max_secret_hits))
-        max_secret = "%f_max_secret_hits_%s" % (time.time(), secret)
-        (_, proto_hits, user_hits, _) = \
-            update_rate_limit(configuration, protocol, ip_addr,
-                              username, authorized,
-                              secret=max_secret)
 
     # Check if we should log abuse messages for use by eg. fail2ban
 
@@ -38,6 +38,7 @@ from mig.shared.base import client_dir_id, client_id_dir, client_alias, \
 from mig.shared.defaults import dav_domain
 from mig.shared.fileio import unpickle
 from mig.shared.gdp.all import get_project_from_user_id
+from mig.shared.jupyter import load_jupyter_mount_state
 from mig.shared.sharelinks import extract_mode_id
 from mig.shared.ssh import parse_pub_key
 from mig.shared.useradm import ssh_authkeys, davs_authkeys, ftps_authkeys, \
@@ -833,7 +834,7 @@ def refresh_jupyter_creds(configuration, protocol, username):
     jupyter_dict = None
     if os.path.islink(link_path) and os.path.exists(link_path):
         sessionid = username
-        jupyter_dict = unpickle(link_path, logger)
+        jupyter_dict = load_jupyter_mount_state(link_path, logger)
         # logger.debug("loaded jupyter dict: %s" % jupyter_dict)
 
     # We only allow connections from active jupyter credentials
@@ -27,6 +27,7 @@
 
 """MiG daemon rate limit functions"""
 
+import hashlib
 import os
 import time
 import traceback
@@ -40,15 +41,67 @@ default_max_secret_hits = 10
 
 _rate_limits_filename = "rate_limits.pck"
 _last_expired_filename = "last_expired"
+# NOTE: binary pickle protocol 2 is much faster and more compact than the
+#       default text protocol 0 and can still be read on both python 2 and 3.
+#       Loading autodetects the protocol so existing files remain readable.
+_rate_limits_pickle_protocol = 2
+# NOTE: rate limits are split into a number of shards by client address so
+#       that each update only has to load and save a fraction of the entries.
+_rate_limits_shards = 16
+
+# NOTE: cache of loaded rate limits dicts for the read-only hit checks.
+#       Maps rate limits file path to a (stat stamp, rate_limits) tuple so that
+#       the file is only unpickled again when another process changed it.
+_rate_limits_cache = {}
+# NOTE: last expire timestamps seen by this process keyed by file path
+_last_expire_cache = {}
+
+
+def _new_rate_limits():
+    """Create an empty rate limits dict with the address and user maps"""
+    return {'addresses': {}, 'users': {}}
+
+
+def _rate_limits_stamp(rate_limits_filepath):
+    """Get a stamp to detect changes to the rate limits file or None if it
+    does not exist.
+    """
+    try:
+        stat_res = os.stat(rate_limits_filepath)
+    except OSError:
+        return None
+    return (stat_res.st_ino, stat_res.st_size, stat_res.st_mtime)
+
+
+def _secret_key(secret):
+    """Map secret to a short fixed size digest for use as secrets map key.
+    The secret is typically a password hash or similar so we only keep the
+    first 8 bytes of a sha256 digest to bound the memory and pickle size.
+    """
+    secret_str = "%s" % secret
+    if not isinstance(secret_str, bytes):
+        secret_str = secret_str.encode('utf8')
+    return hashlib.sha256(secret_str).digest()[:8]
+
+
+def _rate_limits_shard(client_address):
+    """Map client_address to one of the rate limits shards. We use a simple
+    character sum since the builtin hash may be randomized for each process.
+    """
+    return sum([ord(i) for i in client_address]) % _rate_limits_shards
+
 
+def _rate_limits_path(configuration, proto, shard):
+    """Get the path of the rate limits shard file for protocol proto"""
+    return os.path.join(configuration.mig_system_run,
+                        "%s.%02x.%s" % (proto, shard, _rate_limits_filename))
 
-def _acquire_rate_limits_lock(configuration, proto, exclusive=True):
-    """Acquire rate limits lock for protocol proto"""
 
-    flock_filepath = \
-        os.path.join(configuration.mig_system_run,
-                     "%s.%s.lock"
-                     % (proto, _rate_limits_filename))
+def _acquire_rate_limits_lock(configuration, proto, shard, exclusive=True):
+    """Acquire rate limits lock for shard of protocol proto"""
+
+    flock_filepath = "%s.lock" % _rate_limits_path(configuration, proto,
+                                                   shard)
 
     flock = acquire_file_lock(flock_filepath, exclusive=exclusive)
 
@@ -62,40 +115,73 @@ def _release_rate_limits_lock(lock):
 
 def _load_rate_limits(configuration,
                       proto,
-                      do_lock=True):
-    """Load rate limits dict"""
+                      shard,
+                      do_lock=True,
+                      use_cache=False):
+    """Load rate limits dict for shard. The optional use_cache argument can be
+    used to reuse the dict from a previous load if the file is unchanged since
+    then. The cached dict is shared so it must be treated as read-only.
+    """
     logger = configuration.logger
-    rate_limits_filepath = os.path.join(configuration.mig_system_run,
-                                        "%s.%s"
-                                        % (proto, _rate_limits_filename))
+    rate_limits_filepath = _rate_limits_path(configuration, proto, shard)
+    # NOTE: writers change the stamp when they save so a matching stamp means
+    #       the cached copy is current and we can skip both lock and unpickle
+    if use_cache:
+        stamp = _rate_limits_stamp(rate_limits_filepath)
+        # NOTE: no file yet e.g. at daemon start means no limits recorded
+        if stamp is None:
+            _rate_limits_cache.pop(rate_limits_filepath, None)
+            return _new_rate_limits()
+        cached = _rate_limits_cache.get(rate_limits_filepath, None)
+        if cached and cached[0] == stamp:
+            return cached[1]
     if do_lock:
         rate_limits_lock = _acquire_rate_limits_lock(
-            configuration, proto, exclusive=False)
-    # NOTE: file is typically on tmpfs so it may or may not exist at this point
+            configuration, proto, shard, exclusive=False)
+    if use_cache:
+        stamp = _rate_limits_stamp(rate_limits_filepath)
+    # NOTE: file is typically on tmpfs so it may or may not exist here
     result = unpickle(rate_limits_filepath, logger, allow_missing=True)
+    if use_cache and stamp is not None and isinstance(result, dict):
+        _rate_limits_cache[rate_limits_filepath] = (stamp, result)
     if do_lock:
         _release_rate_limits_lock(rate_limits_lock)
 
-    if not isinstance(result, dict):
+    if not isinstance(result, dict) or 'users' not in result:
         logger.warning("failed to retrieve active %s rate limits from %s" % (
             proto, rate_limits_filepath))
-        result = {}
+        result = _new_rate_limits()
 
     return result
 
 
 def _save_rate_limits(configuration,
                       proto,
+                      shard,
                       rate_limits,
                       do_lock=True):
-    """Save rate limits dict"""
+    """Save rate limits dict for shard. The data is written to a temporary
+    file, which then replaces the shard file. That way each save gives the
+    file a new inode and thus a new stamp for the lock-free hit check cache,
+    even for a same size rewrite within the same mtime tick.
+    """
     logger = configuration.logger
-    rate_limits_filepath = os.path.join(configuration.mig_system_run,
-                                        "%s.%s"
-                                        % (proto, _rate_limits_filename))
+    rate_limits_filepath = _rate_limits_path(configuration, proto, shard)
+    tmp_filepath = "%s.tmp" % rate_limits_filepath
     if do_lock:
-        rate_limits_lock = _acquire_rate_limits_lock(configuration, proto)
-    result = pickle(rate_limits, rate_limits_filepath, logger)
+        rate_limits_lock = _acquire_rate_limits_lock(configuration, proto,
+                                                     shard)
+    result = pickle(rate_limits, tmp_filepath, logger,
+                    protocol=_rate_limits_pickle_protocol)
+    if result:
+        try:
+            os.rename(tmp_filepath, rate_limits_filepath)
+        except OSError as exc:
+            logger.error("could not replace %r: %s" %
+                         (rate_limits_filepath, exc))
+            result = False
+    # NOTE: drop any cached copy in this process right away
+    _rate_limits_cache.pop(rate_limits_filepath, None)
     if do_lock:
         _release_rate_limits_lock(rate_limits_lock)
 
@@ -106,14 +192,19 @@ def _save_rate_limits(configuration,
     return result
 
 
-def _get_last_expire(configuration, proto):
-    """Get last expire timestamp"""
+def _get_last_expire(configuration, proto, use_cache=False):
+    """Get last expire timestamp. The optional use_cache argument can be used
+    to return the last timestamp seen by this process without any disk access.
+    """
     last_expired_filepath = os.path.join(configuration.mig_system_run,
                                          "%s.%s"
                                          % (proto, _last_expired_filename))
+    if use_cache and last_expired_filepath in _last_expire_cache:
+        return _last_expire_cache[last_expired_filepath]
     timestamp = 0
     if os.path.exists(last_expired_filepath):
         timestamp = os.path.getmtime(last_expired_filepath)
+    _last_expire_cache[last_expired_filepath] = timestamp
 
     return timestamp
 
@@ -123,7 +214,11 @@ def _set_last_expire(configuration, proto):
     last_expired_filepath = os.path.join(configuration.mig_system_run,
                                          "%s.%s"
                                          % (proto, _last_expired_filename))
-    return touch(last_expired_filepath, configuration)
+    result = touch(last_expired_filepath, configuration)
+    _last_expire_cache.pop(last_expired_filepath, None)
+    if result:
+        _get_last_expire(configuration, proto)
+    return result
 
 
 def hit_rate_limit(configuration, proto, client_address, client_id,
@@ -131,9 +226,9 @@ def hit_rate_limit(configuration, proto, client_address, client_id,
     """Check if proto login from client_address with client_id should be
     filtered due to too many recently failed login attempts.
     The rate limit check lookup in rate limit cache.
-    The rate limit cache is a set of nested dictionaries with
-    client_address, protocol, client_id and secret as keys,
-    the structure is shown in the 'update_rate_limit' doc-string.
+    The rate limit cache is a set of flat dictionaries with client_address
+    and (client_address, client_id) as keys, the structure is shown in the
+    'update_rate_limit' doc-string.
     The rate limit cache maps the number of fails/hits for each
     IP, protocol, username and secret and helps distinguish e.g.
     any other users coming from the same gateway address.
@@ -147,11 +242,12 @@ def hit_rate_limit(configuration, proto, client_address, client_id,
     logger = configuration.logger
     refuse = False
 
-    _rate_limits = _load_rate_limits(configuration, proto)
-    _address_limits = _rate_limits.get(client_address, {})
-    _proto_limits = _address_limits.get(proto, {})
-    _user_limits = _proto_limits.get(client_id, {})
-    proto_hits = _proto_limits.get('hits', 0)
+    shard = _rate_limits_shard(client_address)
+    _rate_limits = _load_rate_limits(configuration, proto, shard,
+                                     use_cache=True)
+    _address_limits = _rate_limits['addresses'].get(client_address, {})
+    _user_limits = _rate_limits['users'].get((client_address, client_id), {})
+    proto_hits = _address_limits.get('hits', 0)
     user_hits = _user_limits.get('hits', 0)
     if user_hits >= max_user_hits:
         refuse = True
@@ -170,33 +266,41 @@ def hit_rate_limit(configuration, proto, client_address, client_id,
 def update_rate_limit(configuration, proto, client_address, client_id,
                       login_success,
                       secret=None,
+                      max_secret_hits=0,
                       ):
     """Update rate limit database after proto login from client_address with
     client_id and boolean login_success status.
     The optional secret can be used to save the hash or similar so that
     repeated failures with the same credentials only count as one error.
     Otherwise some clients will retry on failure and hit the limit easily.
-    The rate limit database is a set of nested dictionaries with
-    client_address, protocol, client_id and secret as keys
-    mapping the number of fails/hits for each IP, protocol, username and secret
+    If the optional max_secret_hits is positive and the secret hits exceed it
+    an additional unique secret is registered in the same update to force
+    address, proto and user hits to increase anyway.
+    The rate limit database for each proto is a set of flat dictionaries
+    with client_address and (client_address, client_id) tuples as keys
+    mapping the number of fails/hits for each IP, username and secret.
     This helps distinguish e.g. any other users coming from the same
-    gateway address.
-    Example of rate limit database entry:
-    {'127.0.0.1': {
-        'fails': int (Total IP fails)
-        'hits': int (Total IP fails)
-        'sftp': {
-            'fails': int (Total protocol fails)
-            'hits': int (Total protocol hits)
-            'user@some-domain.org: {
-                'fails': int (Total user fails)
-                'hits': int (Total user hits)
-                'XXXYYYZZZ': {
-                    'timestamp': float (Last updated)
-                    'hits': int (Total secret hits)
-                }
+    gateway address. As the database is kept per proto the address totals
+    are also the protocol totals.
+    Example of rate limit database entries:
+    {'addresses': {
+        '127.0.0.1': {
+            'fails': int (Total IP fails)
+            'hits': int (Total IP hits)
+        }
+     },
+     'users': {
+        ('127.0.0.1', 'user@some-domain.org'): {
+            'fails': int (Total user fails)
+            'hits': int (Total user hits)
+            'secrets': {
+                sha256(secret)[:8]: (
+                    float (Last updated),
+                    int (Total secret hits)
+                )
             }
         }
+     }
     }
     Returns tuple with updated hits:
     (address_hits, proto_hits, user_hits, secret_hits)
@@ -205,8 +309,6 @@ def update_rate_limit(configuration, proto, client_address, client_id,
     status = {True: "success", False: "failure"}
     address_fails = old_address_fails = 0
     address_hits = old_address_hits = 0
-    proto_fails = old_proto_fails = 0
-    proto_hits = old_proto_hits = 0
     user_fails = old_user_fails = 0
     user_hits = old_user_hits = 0
     secret_hits = old_secret_hits = 0
@@ -214,58 +316,68 @@ def update_rate_limit(configuration, proto, client_address, client_id,
     if not secret:
         secret = timestamp
 
+    shard = _rate_limits_shard(client_address)
     rate_limits_lock = _acquire_rate_limits_lock(
-        configuration, proto, exclusive=True)
-    _rate_limits = _load_rate_limits(configuration, proto, do_lock=False)
+        configuration, proto, shard, exclusive=True)
+    _rate_limits = _load_rate_limits(configuration, proto, shard,
+                                     do_lock=False)
     try:
         # logger.debug("update rate limit db: %s" % _rate_limits)
-        _address_limits = _rate_limits.get(client_address, {})
-        if not _address_limits:
-            _rate_limits[client_address] = _address_limits
-        _proto_limits = _address_limits.get(proto, {})
-        if not _proto_limits:
-            _address_limits[proto] = _proto_limits
-        _user_limits = _proto_limits.get(client_id, {})
+        _address_map = _rate_limits['addresses']
+        _user_map = _rate_limits['users']
+        user_key = (client_address, client_id)
+        _address_limits = _address_map.get(client_address, {})
+        _user_limits = _user_map.get(user_key, {})
 
         address_fails = old_address_fails = _address_limits.get('fails', 0)
         address_hits = old_address_hits = _address_limits.get('hits', 0)
-        proto_fails = old_proto_fails = _proto_limits.get('fails', 0)
-        proto_hits = old_proto_hits = _proto_limits.get('hits', 0)
         user_fails = old_user_fails = _user_limits.get('fails', 0)
         user_hits = old_user_hits = _user_limits.get('hits', 0)
+        # NOTE: only save if counters actually change. A successful login
+        #       without any recorded user failures leaves everything as is.
+        dirty = False
         if login_success:
             if _user_limits:
+                dirty = True
                 address_fails -= user_fails
                 address_hits -= user_hits
-                proto_fails -= user_fails
-                proto_hits -= user_hits
                 user_fails = user_hits = 0
-                del _proto_limits[client_id]
+                del _user_map[user_key]
         else:
+            dirty = True
             if not _user_limits:
-                _proto_limits[client_id] = _user_limits
-            _secret_limits = _user_limits.get(secret, {})
-            if not _secret_limits:
-                _user_limits[secret] = _secret_limits
-            secret_hits = old_secret_hits = _secret_limits.get('hits', 0)
+                _user_limits['secrets'] = {}
+                _user_map[user_key] = _user_limits
+            _secret_map = _user_limits['secrets']
+            secret_key = _secret_key(secret)
+            (_, secret_hits) = _secret_map.get(secret_key, (None, 0))
+            old_secret_hits = secret_hits
             if secret_hits == 0:
                 address_hits += 1
-                proto_hits += 1
                 user_hits += 1
             address_fails += 1
-            proto_fails += 1
             user_fails += 1
             secret_hits += 1
-            _secret_limits['timestamp'] = timestamp
-            _secret_limits['hits'] = secret_hits
+            _secret_map[secret_key] = (timestamp, secret_hits)
+            # NOTE: register the extra unique secret here rather than in a
+            #       separate call to avoid another full load and save
+            if max_secret_hits > 0 and secret_hits > max_secret_hits:
+                max_secret = "%f_max_secret_hits_%s" % (timestamp, secret)
+                _secret_map[_secret_key(max_secret)] = (timestamp, 1)
+                address_hits += 1
+                user_hits += 1
+                address_fails += 1
+                user_fails += 1
             _user_limits['fails'] = user_fails
             _user_limits['hits'] = user_hits
-        _address_limits['fails'] = address_fails
-        _address_limits['hits'] = address_hits
-        _proto_limits['fails'] = proto_fails
-        _proto_limits['hits'] = proto_hits
-        if not _save_rate_limits(configuration,
-                                 proto, _rate_limits, do_lock=False):
+        if dirty:
+            if address_fails > 0:
+                _address_map[client_address] = {'fails': address_fails,
+                                                'hits': address_hits}
+            else:
+                _address_map.pop(client_address, None)
+        if dirty and not _save_rate_limits(
+                configuration, proto, shard, _rate_limits, do_lock=False):
             raise IOError("%s save rate limits failed for %s" %
                           (proto, client_id))
     except Exception as exc:
@@ -281,10 +393,6 @@ def update_rate_limit(configuration, proto, client_address, client_id,
                  % (old_address_fails, address_fails)
                  + "old_address_hits: %d -> %d\n"
                  % (old_address_hits, address_hits)
-                 + "old_proto_fails: %d -> %d\n"
-                 % (old_proto_fails, proto_fails)
-                 + "old_proto_hits: %d -> %d\n"
-                 % (old_proto_hits, proto_hits)
                  + "old_user_fails: %d -> %d\n"
                  % (old_user_fails, user_fails)
                  + "old_user_hits: %d -> %d\n"
@@ -298,7 +406,8 @@ def update_rate_limit(configuration, proto, client_address, client_id,
                     + " %s for %s" % (status[login_success], client_address)
                     + " from %d to %d hits" % (old_user_hits, user_hits))
 
-    return (address_hits, proto_hits, user_hits, secret_hits)
+    # NOTE: address limits are kept per proto so they are also proto limits
+    return (address_hits, address_hits, user_hits, secret_hits)
 
 
 def expire_rate_limit(configuration, proto,
@@ -312,93 +421,72 @@ def expire_rate_limit(configuration, proto,
     """
     logger = configuration.logger
     now = time.time()
-    address_fails = old_address_fails = 0
-    address_hits = old_address_hits = 0
-    proto_fails = old_proto_fails = 0
-    proto_hits = old_proto_hits = 0
-    user_fails = old_user_fails = 0
-    user_hits = old_user_hits = 0
     expired = 0
     logger.debug("expire %r entries older than %d at %d with delay %d"
                  % (proto, fail_cache, now, expire_delay))
+    # NOTE: the last expire can only have moved forward since we saw it so
+    #       only check the file when the cached value says expire is due
     check_expire = expire_delay \
-        + _get_last_expire(configuration, proto)
+        + _get_last_expire(configuration, proto, use_cache=True)
+    if check_expire <= now:
+        check_expire = expire_delay \
+            + _get_last_expire(configuration, proto)
     if check_expire > now:
         expired = round(now - check_expire)
         logger.debug("Postponed expire for %d seconds using %d seconds delay"
                      % (-expired, expire_delay))
         return expired
 
-    rate_limits_lock = _acquire_rate_limits_lock(
-        configuration, proto, exclusive=True)
-    _rate_limits = _load_rate_limits(configuration, proto, do_lock=False)
-    try:
-        for _client_address in _rate_limits:
-            # debug_msg = "expire addr: %s" % _client_address
-            _address_limits = _rate_limits[_client_address]
-            address_fails = old_address_fails = _address_limits['fails']
-            address_hits = old_address_hits = _address_limits['hits']
-            _proto_limits = _address_limits[proto]
-            # debug_msg += ", proto: %s" % _proto
-            proto_fails = old_proto_fails = _proto_limits['fails']
-            proto_hits = old_proto_hits = _proto_limits['hits']
-            # NOTE: iterate over a copy of proto limit keys to allow delete
-            for _user in list(_proto_limits):
-                if _user in ['hits', 'fails']:
-                    continue
-                # debug_msg += ", user: %s" % _user
-                _user_limits = _proto_limits[_user]
-                user_fails = old_user_fails = _user_limits['fails']
-                user_hits = old_user_hits = _user_limits['hits']
-                # NOTE: iterate over a copy of user limit keys to allow delete
-                for _secret in list(_user_limits):
-                    if _secret in ['hits', 'fails']:
-                        continue
-                    _secret_limits = _user_limits[_secret]
-                    if _secret_limits['timestamp'] + fail_cache < now:
-                        secret_hits = _secret_limits['hits']
-                        # debug_msg += \
-                        #"\ntimestamp: %s, secret_hits: %d" \
-                        #    % (_secret_limits['timestamp'], secret_hits) \
-                        #    + ", secret: %s" % _secret
-                        address_fails -= secret_hits
-                        address_hits -= 1
-                        proto_fails -= secret_hits
-                        proto_hits -= 1
-                        user_fails -= secret_hits
-                        user_hits -= 1
-                        del _user_limits[_secret]
-                        expired += 1
-                _user_limits['fails'] = user_fails
-                _user_limits['hits'] = user_hits
-                # debug_msg += "\nold_user_fails: %d -> %d" \
-                # % (old_user_fails, user_fails) \
-                #    + "\nold_user_hits: %d -> %d" \
-                #    % (old_user_hits, user_hits)
-                if user_fails == 0:
-                    # debug_msg += "\nRemoving expired user: %s" % _user
-                    del _proto_limits[_user]
-            _proto_limits['fails'] = proto_fails
-            _proto_limits['hits'] = proto_hits
-            # debug_msg += "\nold_proto_fails: %d -> %d" \
-            # % (old_proto_fails, proto_fails) \
-            #    + "\nold_proto_hits: %d -> %d" \
-            #    % (old_proto_hits, proto_hits)
-            _address_limits['fails'] = address_fails
-            _address_limits['hits'] = address_hits
-            # debug_msg += "\nold_address_fails: %d -> %d" \
-            # % (old_address_fails, address_fails) \
-            #    + "\nold_address_hits: %d -> %d" \
-            #    % (old_address_hits, address_hits)
-            # logger.debug(debug_msg)
-        if not _save_rate_limits(configuration,
-                                 proto, _rate_limits, do_lock=False):
-            raise IOError("%s save rate limits failed" % proto)
-    except Exception as exc:
-        logger.error("expire rate limit failed: %s" % exc)
-        logger.info(traceback.format_exc())
+    # NOTE: each shard has its own lock so we expire them one at a time
+    for shard in range(_rate_limits_shards):
+        # NOTE: skip shards without any recorded entries
+        if not os.path.exists(_rate_limits_path(configuration, proto, shard)):
+            continue
+        rate_limits_lock = _acquire_rate_limits_lock(
+            configuration, proto, shard, exclusive=True)
+        _rate_limits = _load_rate_limits(configuration, proto, shard,
+                                         do_lock=False)
+        # NOTE: only save shard if something was actually removed
+        dirty = False
+        try:
+            _address_map = _rate_limits['addresses']
+            _user_map = _rate_limits['users']
+            # NOTE: collect expired entries in one pass and delete after
+            expired_users = []
+            for (user_key, _user_limits) in _user_map.items():
+                _secret_map = _user_limits['secrets']
+                expired_secrets = [
+                    (_secret, secret_hits) for
+                    (_secret, (secret_stamp, secret_hits)) in
+                    _secret_map.items() if secret_stamp + fail_cache < now]
+                if expired_secrets:
+                    dirty = True
+                    _address_limits = _address_map[user_key[0]]
+                    for (_secret, secret_hits) in expired_secrets:
+                        _address_limits['fails'] -= secret_hits
+                        _user_limits['fails'] -= secret_hits
+                        del _secret_map[_secret]
+                    secret_count = len(expired_secrets)
+                    _address_limits['hits'] -= secret_count
+                    _user_limits['hits'] -= secret_count
+                    expired += secret_count
+                if _user_limits['fails'] == 0:
+                    expired_users.append(user_key)
+            for user_key in expired_users:
+                del _user_map[user_key]
+                dirty = True
+            for _address in [i for (i, j) in _address_map.items()
+                             if j['fails'] == 0]:
+                del _address_map[_address]
+                dirty = True
+            if dirty and not _save_rate_limits(
+                    configuration, proto, shard, _rate_limits, do_lock=False):
+                raise IOError("%s save rate limits failed" % proto)
+        except Exception as exc:
+            logger.error("expire rate limit failed: %s" % exc)
+            logger.info(traceback.format_exc())
 
-    _release_rate_limits_lock(rate_limits_lock)
+        _release_rate_limits_lock(rate_limits_lock)
 
     if expired:
         logger.info("expire %s rate limit expired %d items" % (proto,
@@ -407,23 +495,6 @@ def expire_rate_limit(configuration, proto,
 
     _set_last_expire(configuration, proto)
 
-    """
-    logger.debug("\nexpired %d %s rate limit(s)\n"
-                 % (expired, proto)
-                 + "address_fails: %d -> %d\n"
-                 % (old_address_fails, address_fails)
-                 + "address_hits: %d -> %d\n"
-                 % (old_address_hits, address_hits)
-                 + "proto_fails: %d -> %d\n"
-                 % (old_proto_fails, proto_fails)
-                 + "proto_hits: %d -> %d\n"
-                 % (old_proto_hits, proto_hits)
-                 + "user_fails: %d -> %d\n"
-                 % (old_user_fails, user_fails)
-                 + "user_hits: %d -> %d\n"
-                 % (old_user_hits, user_hits))
-    """
-
     return expired
 
 
@@ -28,6 +28,42 @@
 
 """ Jupyter service helper functions """
 
+from mig.shared.base import force_default_str_coding_rec
+from mig.shared.fileio import unpickle
+from mig.shared.logger import null_logger
+from mig.shared.serial import dump, load
+
+
+def save_jupyter_mount_state(jupyter_dict, path, logger):
+    """Save the jupyter_dict mount state in path as json, which is both faster
+    to load and safer to parse than pickle.
+    """
+    if not logger:
+        logger = null_logger("dummy")
+    try:
+        # NOTE: json can't handle bytes e.g. in the key material on python 3
+        dump(force_default_str_coding_rec(jupyter_dict), path,
+             serializer='json', mode='w')
+        return True
+    except Exception as err:
+        logger.error("could not save jupyter mount state %r: %s" % (path, err))
+        return False
+
+
+def load_jupyter_mount_state(path, logger):
+    """Load the jupyter mount state dictionary saved in path. Falls back to
+    unpickle for any state files saved in the legacy pickle format.
+    """
+    if not logger:
+        logger = null_logger("dummy")
+    try:
+        return force_default_str_coding_rec(load(path, serializer='json'))
+    except ValueError:
+        return unpickle(path, logger)
+    except Exception as err:
+        logger.error("could not load jupyter mount state %r: %s" % (path, err))
+        return False
+
 
 def gen_balancer_proxy_template(url, define, name, member_hosts,
                                 ws_member_hosts, timeout=600):
@@ -32,7 +32,7 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-from builtins import zip, range
+from builtins import range
 from base64 import b64encode, b64decode, b16encode, b16decode, \
     urlsafe_b64encode, urlsafe_b64decode
 from os import urandom
@@ -40,6 +40,7 @@ from random import SystemRandom
 from string import ascii_lowercase, ascii_uppercase, digits
 import datetime
 import hashlib
+import hmac
 import time
 
 from mig.shared.base import force_utf8, mask_creds, string_snippet
@@ -51,6 +52,16 @@ try:
 except ImportError:
     # Optional cracklib not available - fail gracefully and check before use
     cracklib = None
+try:
+    # NOTE: fastpbkdf2 is a drop-in replacement but several times faster
+    from fastpbkdf2 import pbkdf2_hmac
+except ImportError:
+    # Optional fastpbkdf2 not available - fall back to the hashlib version
+    from hashlib import pbkdf2_hmac
+# NOTE: older pythons without OpenSSL HMAC support fall back to a pure python
+#       pbkdf2_hmac, which is a lot slower and holds the GIL all the way.
+_pbkdf2_native = getattr(pbkdf2_hmac, '__module__', None) != 'hashlib'
+_pbkdf2_warned = False
 try:
     import cryptography
 except ImportError:
@@ -71,6 +82,28 @@ except ImportError:
 from mig.shared.defaults import POLICY_NONE, POLICY_WEAK, POLICY_MEDIUM, \
     POLICY_HIGH, POLICY_MODERN, POLICY_CUSTOM, PASSWORD_POLICIES
 
+# Map each char in the lower, upper and digits classes to the class name
+_password_char_classes = {}
+for (char_class, values) in [('lower', ascii_lowercase),
+                             ('upper', ascii_uppercase), ('digits', digits)]:
+    _password_char_classes.update([(i, char_class) for i in values])
+
+# Cache of parsed password policy requirements keyed by policy value
+_password_policy_cache = {}
+
+# NOTE: SystemRandom has no state of its own so one instance can be shared
+_system_random = SystemRandom()
+
+# Cache of integer values for the hex salts used in scrambling
+_salt_int_cache = {}
+
+# Caches of auto-derived encryption keys and the Fernet helpers for keys
+_encryption_key_cache = {}
+_fernet_helper_cache = {}
+
+# Random key for the check_hash cache entries - only used in memory
+_hash_cache_hmac_key = urandom(32)
+
 # Parameters to PBKDF2. Only affect new passwords.
 SALT_LENGTH = 12
 KEY_LENGTH = 24
@@ -95,6 +128,8 @@ for algo in hashlib.algorithms_guaranteed:
 sorted_hash_algos = list(valid_hash_algos)
 sorted_hash_algos.sort()
 default_algo = sorted_hash_algos[0]
+_md5_helper = valid_hash_algos['md5']
+_sha256_helper = valid_hash_algos['sha256']
 
 
 def best_crypt_salt(configuration):
@@ -117,13 +152,35 @@ def best_crypt_salt(configuration):
 def make_hash(password):
     """Generate a random salt and return a new hash for the password."""
     salt = b64encode(urandom(SALT_LENGTH))
-    derived = b64encode(hashlib.pbkdf2_hmac(HASH_FUNCTION,
-                                            force_utf8(password), salt,
-                                            COST_FACTOR, KEY_LENGTH))
+    derived = b64encode(pbkdf2_hmac(HASH_FUNCTION, force_utf8(password), salt,
+                                    COST_FACTOR, KEY_LENGTH))
     return 'PBKDF2${}${}${}${}'.format(HASH_FUNCTION, COST_FACTOR,
                                        salt, derived)
 
 
+def _warn_pbkdf2_fallback(configuration):
+    """Log a warning once if only the slow pure python pbkdf2_hmac is
+    available.
+    """
+    global _pbkdf2_warned
+    if _pbkdf2_warned:
+        return
+    _pbkdf2_warned = True
+    configuration.logger.warning(
+        "no native pbkdf2_hmac available - password hashing will be slow and "
+        "serialize threads. Please install fastpbkdf2 or a python built with "
+        "OpenSSL HMAC support.")
+
+
+def _make_hash_cache_key(pw_bytes, hash_bytes):
+    """Make a hash_cache key for the pw_bytes and hash_bytes combination. We
+    use a HMAC with a random per-process key so that plain password digests
+    are never kept in memory and users sharing a password get separate entries.
+    """
+    return hmac.new(_hash_cache_hmac_key, pw_bytes + b'$' + hash_bytes,
+                    hashlib.sha256).digest()
+
+
 def check_hash(configuration, service, username, password, hashed,
                hash_cache=None, strict_policy=True, allow_legacy=False):
     """Check a password against an existing hash. First make sure the provided
@@ -140,12 +197,14 @@ def check_hash(configuration, service, username, password, hashed,
     _logger = configuration.logger
     # NOTE: hashlib works with bytes
     hash_bytes = force_utf8(hashed)
-    pw_hash = make_simple_hash(password)
-    if isinstance(hash_cache, dict) and \
-            hash_cache.get(pw_hash, None) == hash_bytes:
-
-        # _logger.debug("got cached hash: %s" % [hash_cache.get(pw_hash, None)])
-        return True
+    # NOTE: pbkdf2_hmac requires bytes for password and salt
+    pw_bytes = force_utf8(password)
+    pw_hash = None
+    if isinstance(hash_cache, dict):
+        pw_hash = _make_hash_cache_key(pw_bytes, hash_bytes)
+        if hash_cache.get(pw_hash, None) == hash_bytes:
+            # _logger.debug("got cached hash: %s" % [hash_cache.get(pw_hash, None)])
+            return True
     # We check policy AFTER cache lookup since it is already verified for those
     if strict_policy:
         try:
@@ -157,30 +216,38 @@ def check_hash(configuration, service, username, password, hashed,
     else:
         _logger.debug("password policy check disabled for %s login as %s" %
                       (service, username))
+    if not _pbkdf2_native:
+        _warn_pbkdf2_fallback(configuration)
     algorithm, hash_function, cost_factor, salt, hash_a = hashed.split('$')
     assert algorithm == 'PBKDF2'
     hash_a = b64decode(hash_a)
-    # NOTE: pbkdf2_hmac requires bytes for password and salt
-    pw_bytes = force_utf8(password)
-    hash_b = hashlib.pbkdf2_hmac(hash_function, pw_bytes, force_utf8(salt),
-                                 int(cost_factor), len(hash_a))
+    hash_b = pbkdf2_hmac(hash_function, pw_bytes, force_utf8(salt),
+                         int(cost_factor), len(hash_a))
     assert len(hash_a) == len(hash_b)  # we requested this from pbkdf2_hmac()
     # Same as "return hash_a == hash_b" but takes a constant time.
     # See http://carlos.bueno.org/2011/10/timing.html
-    diff = 0
-    for char_a, char_b in zip(hash_a, hash_b):
-        diff |= ord(char_a) ^ ord(char_b)
-    match = (diff == 0)
-    if isinstance(hash_cache, dict) and match:
+    match = hmac.compare_digest(hash_a, hash_b)
+    if pw_hash is not None and match:
         hash_cache[pw_hash] = hash_bytes
         # print("cached hash: %s" % hash_cache.get(pw_hash, None))
     return match
 
 
+def _salt_int(salt):
+    """Look up integer value of the hex salt string. Salts are static so we
+    only parse each of them once.
+    """
+    salt_int = _salt_int_cache.get(salt, None)
+    if salt_int is None:
+        salt_int = int(salt, 16)
+        _salt_int_cache[salt] = salt_int
+    return salt_int
+
+
 def scramble_digest(salt, digest):
     """Scramble digest for saving"""
     b16_digest = b16encode(digest)
-    xor_int = int(salt, 16) ^ int(b16_digest, 16)
+    xor_int = _salt_int(salt) ^ int(b16_digest, 16)
     # Python 2.6 fails to parse implicit positional args (-Jonas)
     # return '{:X}'.format(xor_int)
     return '{0:X}'.format(xor_int)
@@ -188,21 +255,26 @@ def scramble_digest(salt, digest):
 
 def unscramble_digest(salt, digest):
     """Unscramble loaded digest"""
-    xor_int = int(salt, 16) ^ int(digest, 16)
+    xor_int = _salt_int(salt) ^ int(digest, 16)
     # Python 2.6 fails to parse implicit positional args (-Jonas)
     # b16_digest = '{:X}'.format(xor_int)
     b16_digest = '{0:X}'.format(xor_int)
     return b16decode(b16_digest)
 
 
-def make_digest(realm, username, password, salt):
-    """Generate a digest for the credentials"""
-    merged_creds = ':'.join([realm, username, password])
+def _make_merged_digest(merged_creds, salt):
+    """Generate a digest for the already merged credentials"""
     # TODO: can we switch to proper md5 hexdigest without breaking webdavs?
     digest = 'DIGEST$custom$CONFSALT$%s' % scramble_digest(salt, merged_creds)
     return digest
 
 
+def make_digest(realm, username, password, salt):
+    """Generate a digest for the credentials"""
+    merged_creds = ':'.join([realm, username, password])
+    return _make_merged_digest(merged_creds, salt)
+
+
 def check_digest(configuration, service, realm, username, password, digest,
                  salt, digest_cache=None, strict_policy=True,
                  allow_legacy=False):
@@ -231,8 +303,9 @@ def check_digest(configuration, service, realm, username, password, digest,
                         % (service, username, exc))
         if strict_policy:
             return False
-    computed = make_digest(realm, username, password, salt)
-    match = (computed == digest)
+    # NOTE: reuse merged_creds from cache lookup rather than merging again
+    computed = _make_merged_digest(merged_creds, salt)
+    match = hmac.compare_digest(force_utf8(computed), force_utf8(digest))
     if isinstance(digest_cache, dict) and match:
         digest_cache[creds_hash] = digest
         # print("cached digest: %s" % digest_cache.get(creds_hash, None))
@@ -245,7 +318,7 @@ def scramble_password(salt, password):
     """
     if not salt or not password:
         return b64encode(password)
-    xor_int = int(salt, 16) ^ int(b16encode(password), 16)
+    xor_int = _salt_int(salt) ^ int(b16encode(password), 16)
     return '{0:X}'.format(xor_int)
 
 
@@ -256,7 +329,7 @@ def unscramble_password(salt, password):
     if not salt:
         unscrambled = b64decode(password)
         return unscrambled
-    xor_int = int(salt, 16) ^ int(password, 16)
+    xor_int = _salt_int(salt) ^ int(password, 16)
     b16_password = '{0:X}'.format(xor_int)
     return b16decode(b16_password)
 
@@ -294,7 +367,7 @@ def check_scramble(configuration, service, username, password, scrambled,
         if strict_policy:
             return False
     computed = make_scramble(password, salt)
-    match = (computed == scrambled)
+    match = hmac.compare_digest(force_utf8(computed), force_utf8(scrambled))
     if isinstance(scramble_cache, dict) and match:
         scramble_cache[password] = scrambled
         # print("cached digest: %s" % scramble_cache.get(password, None))
@@ -320,15 +393,24 @@ def _prepare_encryption_key(configuration, secret=keyword_auto,
         # yet salt it with hash of a site-specific and non-public salt
         # to avoid disclosing salt or final key.
         salt_data = best_crypt_salt(configuration)
+        # NOTE: the final key only depends on salt, entropy and format here
+        #       so we derive it once and then just return the cached key
+        cache_key = (salt_data, entropy, key_bytes, urlsafe)
+        key = _encryption_key_cache.get(cache_key, None)
+        if key is not None:
+            return key
         salt_hash = make_safe_hash(salt_data)
         key_data = scramble_password(salt_hash, entropy)
     else:
         # _logger.debug('making crypto key from provided secret')
+        cache_key = None
         key_data = secret
     if urlsafe:
         key = urlsafe_b64encode(key_data[:key_bytes])
     else:
         key = key_data[:key_bytes]
+    if cache_key is not None:
+        _encryption_key_cache[cache_key] = key
     return key
 
 
@@ -340,6 +422,17 @@ def prepare_fernet_key(configuration, secret=keyword_auto):
     return _prepare_encryption_key(configuration, secret, key_bytes=32)
 
 
+def _get_fernet_helper(key):
+    """Get a Fernet helper object for key. The helpers are stateless so we
+    cache and reuse them to avoid key parsing on every call.
+    """
+    fernet_helper = _fernet_helper_cache.get(key, None)
+    if fernet_helper is None:
+        fernet_helper = Fernet(key)
+        _fernet_helper_cache[key] = fernet_helper
+    return fernet_helper
+
+
 def fernet_encrypt_password(configuration, password, secret=keyword_auto):
     """Encrypt password with strong Fernet algorithm for saving passwords and
     the like. Encryption implicitly relies on a random initialization vector
@@ -352,7 +445,7 @@ def fernet_encrypt_password(configuration, password, secret=keyword_auto):
     if cryptography and Fernet:
         key = prepare_fernet_key(configuration, secret)
         password = force_utf8(password)
-        fernet_helper = Fernet(key)
+        fernet_helper = _get_fernet_helper(key)
         encrypted = fernet_helper.encrypt(password)
     else:
         _logger.error('fernet encrypt requested without proper cryptography')
@@ -365,7 +458,7 @@ def fernet_decrypt_password(configuration, encrypted, secret=keyword_auto):
     _logger = configuration.logger
     if cryptography and Fernet:
         key = prepare_fernet_key(configuration, secret)
-        fernet_helper = Fernet(key)
+        fernet_helper = _get_fernet_helper(key)
         password = fernet_helper.decrypt(encrypted)
     else:
         _logger.error('fernet decrypt requested without proper cryptography')
@@ -589,7 +682,8 @@ def check_encrypt(configuration, service, username, password, encrypted,
                         % (service, username, exc))
         if strict_policy:
             return False
-    match = (make_encrypt(configuration, password, secret, algo) == encrypted)
+    computed = make_encrypt(configuration, password, secret, algo)
+    match = hmac.compare_digest(force_utf8(computed), force_utf8(encrypted))
     if isinstance(encrypt_cache, dict) and match:
         encrypt_cache[password] = encrypted
         # print("cached digest: %s" % encrypt_cache.get(password, None))
@@ -730,7 +824,7 @@ def make_csrf_token(configuration, method, operation, client_id, limit=None):
     salt = configuration.site_digest_salt
     merged = "%s:%s:%s:%s" % (method, operation, client_id, limit)
     # configuration.logger.debug("CSRF for %s" % merged)
-    xor_id = "%s" % (int(salt, 16) ^ int(b16encode(merged), 16))
+    xor_id = "%s" % (_salt_int(salt) ^ int(b16encode(merged), 16))
     token = make_safe_hash(xor_id)
     return token
 
@@ -747,7 +841,7 @@ def make_csrf_trust_token(configuration, method, operation, args, client_id,
     already part of the args and therefore should not be considered.
     """
     _logger = configuration.logger
-    csrf_op = '%s' % operation
+    csrf_parts = ['%s' % operation]
     if args:
         sorted_keys = sorted(list(args))
     else:
@@ -755,9 +849,9 @@ def make_csrf_trust_token(configuration, method, operation, args, client_id,
     for key in sorted_keys:
         if key in skip_fields:
             continue
-        csrf_op += '_%s' % key
-        for val in args[key]:
-            csrf_op += '_%s' % val
+        csrf_parts.append('%s' % key)
+        csrf_parts += ['%s' % val for val in args[key]]
+    csrf_op = '_'.join(csrf_parts)
     _logger.debug("made csrf_trust from url %s" % csrf_op)
     return make_csrf_token(configuration, method, csrf_op, client_id, limit)
 
@@ -811,7 +905,12 @@ def parse_password_policy(configuration, use_legacy=False):
         policy = configuration.site_password_legacy_policy
     else:
         policy = configuration.site_password_policy
-    min_len, min_classes, errors = password_requirements(policy, _logger)
+    # NOTE: policy values are static so only parse each of them once
+    requirements = _password_policy_cache.get(policy, None)
+    if requirements is None:
+        requirements = password_requirements(policy, _logger)
+        _password_policy_cache[policy] = requirements
+    min_len, min_classes, errors = requirements
     for err in errors:
         _logger.error(err)
     return min_len, min_classes
@@ -836,18 +935,12 @@ def __assure_password_strength_helper(configuration, password, use_legacy=False)
     if len(password) < min_len:
         raise ValueError('%s: password too short, at least %d chars required' %
                          (policy_fail_msg, min_len))
-    char_class_map = {'lower': ascii_lowercase, 'upper': ascii_uppercase,
-                      'digits': digits}
-    base_chars = ''.join(list(char_class_map.values()))
-    pw_classes = []
+    pw_classes = set()
     for i in password:
-        if i not in base_chars and 'other' not in pw_classes:
-            pw_classes.append('other')
-            continue
-        for (char_class, values) in list(char_class_map.items()):
-            if i in "%s" % values and not char_class in pw_classes:
-                pw_classes.append(char_class)
-                break
+        pw_classes.add(_password_char_classes.get(i, 'other'))
+        # No need to look any further once policy is satisfied
+        if len(pw_classes) >= min_classes:
+            break
     if len(pw_classes) < min_classes:
         raise ValueError('%s: password too simple, >= %d char classes required' %
                          (policy_fail_msg, min_classes))
@@ -922,9 +1015,9 @@ def make_generic_hash(val, algo, hex_format=True):
     hexdigest if hex_format is set (default) or the corresponding raw N bytes
     otherwise.
     """
-    if not algo in valid_hash_algos:
-        algo = default_algo
-    hash_helper = valid_hash_algos[algo]
+    hash_helper = valid_hash_algos.get(algo, None)
+    if hash_helper is None:
+        hash_helper = valid_hash_algos[default_algo]
     if hex_format:
         return hash_helper(val).hexdigest()
     else:
@@ -935,14 +1028,22 @@ def make_simple_hash(val, hex_format=True):
     """Generate a simple md5 hash for val and return the 32-char hexdigest if
     the default hex_format is set or the corresponding raw 16 bytes otherwise.
     """
-    return make_generic_hash(val, 'md5', hex_format)
+    # NOTE: call md5 directly as this is used a lot e.g. for path hashes
+    if hex_format:
+        return _md5_helper(val).hexdigest()
+    else:
+        return _md5_helper(val).digest()
 
 
 def make_safe_hash(val, hex_format=True):
     """Generate a safe sha256 hash for val and return the 64-char hexdigest if
     the default hex_format is set or the corresponding raw 32 bytes otherwise.
     """
-    return make_generic_hash(val, 'sha256', hex_format)
+    # NOTE: call sha256 directly as this is used a lot e.g. for CSRF tokens
+    if hex_format:
+        return _sha256_helper(val).hexdigest()
+    else:
+        return _sha256_helper(val).digest()
 
 
 def make_path_hash(configuration, path):
@@ -962,7 +1063,8 @@ def make_path_hash(configuration, path):
 
 def generate_random_ascii(count, charset):
     """Generate a string of count random characters from given charset"""
-    return ''.join(SystemRandom().choice(charset) for _ in range(count))
+    choice = _system_random.choice
+    return ''.join([choice(charset) for _ in range(count)])
 
 
 def generate_random_password(configuration, tries=42):
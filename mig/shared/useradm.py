@@ -2123,7 +2123,8 @@ def search_users(search_filter, conf_path, db_path,
                  verbose=False, do_lock=True, regex_match=[]):
     """Search for matching users. The optional regex_match is a list of keys in
     search_filter to apply regular expression match rather than the usual
-    fnmatch for.
+    fnmatch for. The values for those keys may be given as either pattern
+    strings or precompiled regular expressions.
     """
 
     if conf_path:
@@ -2151,6 +2152,16 @@ def search_users(search_filter, conf_path, db_path,
         _logger.error(err_msg)
         return (configuration, [])
 
+    # Compile any regex filters once rather than for every user
+    regex_filters = {}
+    for key in regex_match:
+        if key not in search_filter:
+            continue
+        val = search_filter[key]
+        if not hasattr(val, 'match'):
+            val = re.compile(val)
+        regex_filters[key] = val
+
     hits = []
     for (uid, user_dict) in user_db.items():
         match = True
@@ -2163,11 +2174,11 @@ def search_users(search_filter, conf_path, db_path,
                 if user_dict.get('expire', 0) > val:
                     match = False
                     break
-            elif key in regex_match and \
-                    not re.match(val, "%s" % user_dict.get(key, '')):
+            elif key in regex_filters and \
+                    not regex_filters[key].match("%s" % user_dict.get(key, '')):
                 match = False
                 break
-            elif key not in regex_match and \
+            elif key not in regex_filters and \
                     not fnmatch.fnmatch("%s" % user_dict.get(key, ''), val):
                 match = False
                 break
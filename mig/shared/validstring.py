@@ -46,6 +46,11 @@ from mig.shared.defaults import keyword_auto, session_id_length, \
 from mig.shared.fileio import user_chroot_exceptions, untrusted_store_res_symlink
 from mig.shared.logger import null_logger
 
+# Init global email address extraction regexp once and for all
+# NOTE: address must end in letter(s) to avoid trailing period, etc.
+email_extract_pattern = r'[\w\._-]+@[\w\.-]+[\w]+'
+email_extract_expr = re.compile(email_extract_pattern)
+
 
 def cert_name_format(input_string):
     """ Spaces in certificate names are replaced with underscore internally """
@@ -139,9 +144,8 @@ def is_valid_email_address(addr, logger, with_dns=False):
 def valid_email_addresses(configuration, text, lowercase=True):
     """Extract list of all valid email addresses found in free-form text"""
     _logger = configuration.logger
-    # NOTE: address must end in letter(s) to avoid trailing period, etc.
     email_list = []
-    all_matches = re.findall(r'[\w\._-]+@[\w\.-]+[\w]+', text)
+    all_matches = email_extract_expr.findall(text)
     for i in all_matches:
         email = "%s" % i
         if lowercase:
@@ -312,13 +316,11 @@ def valid_user_path(configuration, path, home_dir, allow_equal=False,
     real_home = os.path.realpath(abs_home)
     accept_roots = [real_home] + chroot_exceptions
     # _logger.debug("check that path %s (%s) is inside %s" % (path, real_path, accept_roots))
-    accepted = False
-    for accept_path in accept_roots:
-        if real_path == accept_path or \
-                real_path.startswith(accept_path + os.sep):
-            accepted = True
-            # _logger.debug("path %s is inside chroot %s" % (real_path, accept_path))
-            break
+    # NOTE: a single startswith on a tuple of prefixes checks all roots in C
+    accept_prefixes = tuple([accept_path + os.sep for accept_path in
+                             accept_roots])
+    accepted = real_path in accept_roots or \
+        real_path.startswith(accept_prefixes)
     if not accepted:
         _logger.error("%s is outside chroot boundaries!" % path)
         return False
@@ -33,7 +33,8 @@ import time
 import logging
 
 from mig.shared.griddaemons.ratelimits import default_max_user_hits, \
-    expire_rate_limit, hit_rate_limit, update_rate_limit
+    expire_rate_limit, hit_rate_limit, update_rate_limit, \
+    _load_rate_limits, _rate_limits_shards
 from mig.shared.griddaemons.sessions import active_sessions, \
     clear_sessions, get_active_session, get_open_sessions, \
     track_open_session, track_close_session, track_close_expired_sessions
@@ -55,6 +56,40 @@ if __name__ == "__main__":
     print("Force expire all")
     expired = expire_rate_limit(conf, test_proto, fail_cache=0)
     print("Expired: %s" % expired)
+    print("Test rate limit counters")
+    expected_hits = [
+        # (secret, max_secret_hits, login_success,
+        #  (address_hits, proto_hits, user_hits, secret_hits))
+        (test_pw, 0, False, (1, 1, 1, 1)),
+        (test_pw, 0, False, (1, 1, 1, 2)),
+        (test_pw + 'x', 0, False, (2, 2, 2, 1)),
+        (test_pw, 1, False, (3, 3, 3, 3)),
+        (test_pw, 0, True, (0, 0, 0, 0)),
+        (test_pw, 0, False, (1, 1, 1, 1)),
+    ]
+    for (this_pw, max_secret_hits, success, expected) in expected_hits:
+        hits = update_rate_limit(conf, test_proto, test_address, test_id,
+                                 success, this_pw,
+                                 max_secret_hits=max_secret_hits)
+        if hits != expected:
+            print("ERROR: Expected hits %s for %s:%s (%s), found: %s"
+                  % (expected, test_id, this_pw, success, hits))
+            sys.exit(1)
+    print("OK")
+    print("Test force expire prunes all entries")
+    time.sleep(1)
+    expired = expire_rate_limit(conf, test_proto, fail_cache=0,
+                                expire_delay=0)
+    if expired != 1:
+        print("ERROR: Expected 1 expired entry, found: %s" % expired)
+        sys.exit(1)
+    for shard in range(_rate_limits_shards):
+        rate_limits = _load_rate_limits(conf, test_proto, shard)
+        if rate_limits['addresses'] or rate_limits['users']:
+            print("ERROR: Expected empty rate limits in shard %d: %s"
+                  % (shard, rate_limits))
+            sys.exit(1)
+    print("OK")
     this_pw = test_pw
     print("Emulate rate limit")
     for i in range(default_max_user_hits-1):